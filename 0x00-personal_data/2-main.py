@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+"""
+Main file
+"""
+
+import json
+
+get_logger = __import__('filtered_logger').get_logger
+
+columns = ('name', 'email', 'phone', 'ssn', 'password', 'ip')
+row = ('bob', 'bob@dylan.com', '555-0100', '000-12-3456', 'bobby2019',
+       '10.0.0.1')
+
+logger = get_logger(structured=True)
+logger.info(row, extra={'columns': columns})
+logger.info(list(row), extra={'columns': columns})
+logger.info(dict(zip(columns, row)))
+logger.info(json.dumps(dict(zip(columns, row))))
+logger.info("name=bob;email=bob@dylan.com;ip=10.0.0.1;")
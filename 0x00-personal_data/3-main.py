@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""
+Main file
+"""
+
+import io
+import os
+import tempfile
+
+filter_datum = __import__('filtered_logger').filter_datum
+redact_file = __import__('redact_logs').redact_file
+
+fields = ['name', 'email', 'ssn', 'password']
+lines = ["user logged in name=bob\nemail=x@y.z; ip=1.2.3.4;\n",
+         "status=failed name=bob;email=a@b.c;\n",
+         "name=alice;ssn=000-12-3456;password=\n",
+         "no pii here;\n"] * 1000
+
+with tempfile.NamedTemporaryFile('w', suffix='.log', delete=False) as f:
+    f.writelines(lines)
+try:
+    expected = ''.join(filter_datum(fields, '***', line, ';')
+                       for line in ''.join(lines).splitlines(True))
+    for workers in (1, 2):
+        out = io.BytesIO()
+        redact_file(f.name, out, fields, '***', ';', workers, 4096)
+        print(workers, out.getvalue().decode() == expected)
+    print(repr(expected.splitlines(True)[0] + expected.splitlines(True)[1]))
+finally:
+    os.remove(f.name)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+""" Benchmarks how the batch bcrypt APIs scale with the pool size """
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from typing import List
+
+from encrypt_password import hash_passwords_many, verify_many
+
+
+def worker_counts(limit: int) -> List[int]:
+    """ Returns 1, 2, 4, ... up to and including limit """
+    counts = [1]
+    while counts[-1] * 2 <= limit:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != limit:
+        counts.append(limit)
+    return counts
+
+
+def run(count: int, max_workers: int, processes: bool) -> dict:
+    """ Times hashing then verifying count passwords per pool size
+
+    Speedup is relative to a single worker; near-linear speedup with
+    threads shows bcrypt runs without holding the GIL.
+    """
+    passwords = [f"password-{i}" for i in range(count)]
+    results = []
+    for workers in worker_counts(max_workers):
+        started = time.perf_counter()
+        hashed = list(hash_passwords_many(passwords, workers, processes))
+        hash_elapsed = time.perf_counter() - started
+
+        started = time.perf_counter()
+        valid = list(verify_many(zip(hashed, passwords), workers,
+                                 processes))
+        verify_elapsed = time.perf_counter() - started
+        if not all(valid):
+            raise RuntimeError("verify_many rejected a valid password")
+
+        results.append({
+            'workers': workers,
+            'hashes_per_sec': count / hash_elapsed,
+            'verifies_per_sec': count / verify_elapsed,
+        })
+
+    base = results[0]
+    for result in results:
+        result['hash_speedup'] = (result['hashes_per_sec'] /
+                                  base['hashes_per_sec'])
+        result['verify_speedup'] = (result['verifies_per_sec'] /
+                                    base['verifies_per_sec'])
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'pool': 'process' if processes else 'thread',
+        'passwords': count,
+        'results': results,
+    }
+
+
+def main() -> None:
+    """ Parses the command line and writes the results as JSON """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=32,
+                        help="passwords hashed per pool size")
+    parser.add_argument('--max-workers', type=int,
+                        default=os.cpu_count() or 1)
+    parser.add_argument('--processes', action='store_true',
+                        help="use a process pool instead of threads")
+    parser.add_argument('--output', default='-',
+                        help="JSON results file, '-' for stdout (default)")
+    args = parser.parse_args()
+
+    report = run(args.count, args.max_workers, args.processes)
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
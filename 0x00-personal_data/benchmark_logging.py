@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+""" Benchmarks the redaction strategies of filtered_logger """
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import re
+import string
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+from filtered_logger import (PII_FIELDS, RedactingFormatter, filter_datum,
+                             format_row, get_logger)
+
+
+def legacy_filter_datum(fields: List[str], redaction: str, message: str,
+                        separator: str) -> str:
+    """ The original one re.sub per field implementation, for reference """
+    for field in fields:
+        message = re.sub(f'{field}=(.*?){separator}',
+                         f'{field}={redaction}{separator}', message)
+    return message
+
+
+def make_corpus(records: int, fields: int, value_length: int,
+                pii_density: float, seed: int) -> List[Dict[str, str]]:
+    """ Returns synthetic rows with a share of PII columns
+
+    At most len(PII_FIELDS) columns can be PII; the rest are filler
+    columns. The same seed always yields the same corpus.
+    """
+    rng = random.Random(seed)
+    pii = min(len(PII_FIELDS), round(fields * pii_density))
+    columns = list(PII_FIELDS[:pii]) + [f'field{i}'
+                                        for i in range(fields - pii)]
+    rng.shuffle(columns)
+    alphabet = string.ascii_letters + string.digits + '@.-_ '
+    return [{column: ''.join(rng.choices(alphabet, k=value_length))
+             for column in columns}
+            for _ in range(records)]
+
+
+def make_strategies() -> Dict[str, Callable[[Dict[str, str]], Callable]]:
+    """ Returns the strategies as factories of a per-row callable
+
+    A factory gets the first row, so schema-dependent state is built
+    once, and returns a function redacting one row.
+    """
+    fields = list(PII_FIELDS)
+    text_formatter = RedactingFormatter(fields)
+    structured_formatter = RedactingFormatter(fields, structured=True)
+
+    def text(row: Dict[str, str]) -> str:
+        """ Returns the row as field=value; text """
+        return ''.join([f'{k}={v};' for k, v in row.items()])
+
+    def record(msg, **extra) -> logging.LogRecord:
+        """ Returns a log record for msg """
+        log_record = logging.LogRecord("user_data", logging.INFO, None,
+                                       None, msg, None, None)
+        log_record.__dict__.update(extra)
+        return log_record
+
+    def formatter_row(sample: Dict[str, str]) -> Callable:
+        """ Masks rows by column index """
+        columns = tuple(sample)
+        return lambda row: text_formatter.format(
+            record(tuple(row.values()), columns=columns))
+
+    return {
+        'legacy_re_sub': lambda sample: lambda row: legacy_filter_datum(
+            fields, '***', text(row), ';'),
+        'filter_datum': lambda sample: lambda row: filter_datum(
+            fields, '***', text(row), ';'),
+        'formatter_text': lambda sample: lambda row: text_formatter.format(
+            record(text(row))),
+        'formatter_row': formatter_row,
+        'formatter_structured': lambda sample: lambda row:
+            structured_formatter.format(record(row)),
+        'format_row_unredacted': lambda sample: lambda row: format_row(
+            tuple(row), tuple(row.values())),
+    }
+
+
+def time_calls(func: Callable, corpus: List[Dict[str, str]]) -> List[int]:
+    """ Returns the latency of func on every row, in nanoseconds """
+    clock = time.perf_counter_ns
+    latencies = []
+    for row in corpus:
+        started = clock()
+        func(row)
+        latencies.append(clock() - started)
+    return latencies
+
+
+def measure_allocations(func: Callable, corpus: List[Dict[str, str]]
+                        ) -> Dict[str, int]:
+    """ Returns the peak and retained traced memory of a run """
+    tracemalloc.start()
+    for row in corpus:
+        func(row)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'peak_alloc_bytes': peak, 'retained_alloc_bytes': current}
+
+
+def summarize(latencies: List[int]) -> Dict[str, float]:
+    """ Returns throughput and latency percentiles of a timed run """
+    ordered = sorted(latencies)
+    total = sum(ordered)
+    return {
+        'lines_per_sec': len(ordered) / (total / 1e9) if total else 0.0,
+        'p50_us': ordered[len(ordered) // 2] / 1e3,
+        'p99_us': ordered[min(len(ordered) - 1,
+                              int(len(ordered) * 0.99))] / 1e3,
+    }
+
+
+def bench_logger(corpus: List[Dict[str, str]], asynchronous: bool
+                 ) -> Dict[str, float]:
+    """ Times logger.info through get_logger into a null stream
+
+    The asynchronous run includes draining the queue in lines_per_sec,
+    while its latencies only cover the enqueue on the calling thread.
+    """
+    logger = get_logger(asynchronous=asynchronous)
+    handler = logger.handlers[-1]
+    target = handler.listener.handler if asynchronous else handler
+    target.setStream(open(os.devnull, 'w'))
+    messages = [''.join([f'{k}={v};' for k, v in row.items()])
+                for row in corpus]
+    try:
+        started = time.perf_counter()
+        latencies = time_calls(logger.info, messages)
+        if asynchronous:
+            handler.listener.stop()
+        elapsed = time.perf_counter() - started
+    finally:
+        logger.removeHandler(handler)
+        target.stream.close()
+    result = summarize(latencies)
+    result['lines_per_sec'] = len(messages) / elapsed if elapsed else 0.0
+    return result
+
+
+def run(records: int, field_counts: List[int], value_lengths: List[int],
+        densities: List[float], strategies: List[str], seed: int) -> dict:
+    """ Runs every strategy over every corpus shape """
+    factories = make_strategies()
+    results = []
+    for fields in field_counts:
+        for value_length in value_lengths:
+            for density in densities:
+                corpus = make_corpus(records, fields, value_length, density,
+                                     seed)
+                shape = {'fields': fields, 'value_length': value_length,
+                         'pii_density': density, 'records': records}
+                for name in strategies:
+                    if name in ('logger_sync', 'logger_async'):
+                        result = bench_logger(corpus,
+                                              name == 'logger_async')
+                    else:
+                        func = factories[name](corpus[0])
+                        time_calls(func, corpus[:100])
+                        result = summarize(time_calls(func, corpus))
+                        result.update(measure_allocations(func, corpus))
+                    results.append(dict(strategy=name, **shape, **result))
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': seed,
+        'results': results,
+    }
+
+
+def main() -> None:
+    """ Parses the command line and writes the results as JSON """
+    strategies = list(make_strategies()) + ['logger_sync', 'logger_async']
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--fields', type=int, nargs='+', default=[8, 32])
+    parser.add_argument('--value-lengths', type=int, nargs='+',
+                        default=[16, 128])
+    parser.add_argument('--densities', type=float, nargs='+',
+                        default=[0.1, 0.5])
+    parser.add_argument('--strategies', nargs='+', choices=strategies,
+                        default=strategies)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='-',
+                        help="JSON results file, '-' for stdout (default)")
+    args = parser.parse_args()
+
+    report = run(args.records, args.fields, args.value_lengths,
+                 args.densities, args.strategies, args.seed)
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
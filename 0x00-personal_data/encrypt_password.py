@@ -2,21 +2,154 @@
 """
 Encrypting passwords
 """
+from collections import deque
+from concurrent.futures import (Executor, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+import math
+import os
+import threading
+import time
+from typing import Callable, Iterable, Iterator, Tuple
 import bcrypt
 
 
+DEFAULT_ROUNDS = 12
+_rounds = None
+_rounds_lock = threading.Lock()
+
+
+def _time_hash(rounds: int, samples: int = 3) -> float:
+    """ Returns the fastest of a few bcrypt hashes at rounds, in ms """
+    salt = bcrypt.gensalt(rounds)
+    best = math.inf
+    for _ in range(samples):
+        started = time.perf_counter()
+        bcrypt.hashpw(b"calibration", salt)
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def calibrate_rounds(target_ms: float = 250.0, min_rounds: int = 4,
+                     max_rounds: int = 16) -> int:
+    """ Returns the highest bcrypt cost hashing within target_ms here
+
+    Each extra round doubles the work, so a cheap probe is extrapolated
+    and the pick is then measured and lowered until it meets the target.
+    """
+    probe = max(min_rounds, min(8, max_rounds))
+    per_unit = _time_hash(probe) / 2 ** probe
+    rounds = int(math.log2(target_ms / per_unit)) if per_unit else max_rounds
+    rounds = max(min_rounds, min(max_rounds, rounds))
+    while rounds > min_rounds and _time_hash(rounds, 1) > target_ms:
+        rounds -= 1
+    return rounds
+
+
+def get_rounds() -> int:
+    """ Returns the bcrypt cost used for new hashes
+
+    PERSONAL_DATA_BCRYPT_ROUNDS pins it; otherwise
+    PERSONAL_DATA_BCRYPT_TARGET_MS calibrates it once on this machine,
+    under a lock so concurrent first calls wait for a single run.
+    Without either the bcrypt default is kept.
+    """
+    global _rounds
+    if _rounds is None:
+        with _rounds_lock:
+            if _rounds is None:
+                _rounds = _read_rounds()
+    return _rounds
+
+
+def _read_rounds() -> int:
+    """ Returns the bcrypt cost the environment asks for """
+    rounds = os.getenv('PERSONAL_DATA_BCRYPT_ROUNDS')
+    if rounds:
+        return int(rounds)
+    target_ms = os.getenv('PERSONAL_DATA_BCRYPT_TARGET_MS')
+    if target_ms:
+        return calibrate_rounds(float(target_ms))
+    return DEFAULT_ROUNDS
+
+
+def _set_rounds(rounds: int) -> None:
+    """ Sets the bcrypt cost of a worker process to its parent's """
+    global _rounds
+    _rounds = rounds
+
+
 def hash_password(password: str) -> bytes:
     """ Returns a salted, hashed password, which is a byte string """
     encoded = password.encode()
-    hashed = bcrypt.hashpw(encoded, bcrypt.gensalt())
+    hashed = bcrypt.hashpw(encoded, bcrypt.gensalt(get_rounds()))
 
     return hashed
 
 
-def is_valid(hashed_password: bytes, password: str) -> bool:
-    """ Validates the provided password matches the hashed password """
+def needs_rehash(hashed_password: bytes) -> bool:
+    """ Returns whether a hash uses a lower cost than new hashes """
+    try:
+        return int(hashed_password.split(b'$')[2]) < get_rounds()
+    except (IndexError, ValueError):
+        return True
+
+
+def is_valid(hashed_password: bytes, password: str,
+             on_rehash: Callable[[bytes], None] = None) -> bool:
+    """ Validates the provided password matches the hashed password
+
+    When the password matches but the hash uses an outdated cost,
+    on_rehash is called with a fresh hash so the caller can store it.
+    """
     valid = False
     encoded = password.encode()
     if bcrypt.checkpw(encoded, hashed_password):
         valid = True
+        if on_rehash is not None and needs_rehash(hashed_password):
+            on_rehash(hash_password(password))
     return valid
+
+
+def _is_valid_pair(pair: Tuple[bytes, str]) -> bool:
+    """ Unpacks a (hashed_password, password) pair for is_valid """
+    return is_valid(*pair)
+
+
+def _ordered_map(func: Callable, items: Iterable, workers: int = None,
+                 processes: bool = False) -> Iterator:
+    """ Yields func(item) for every item, in input order
+
+    Work runs on a pool sized to the CPU count by default. bcrypt
+    releases the GIL, so threads already scale; processes are available
+    for callers who want them, and get the cost settled here instead of
+    each calibrating its own. At most two items per worker are in
+    flight, so results stream back without reading all the input first.
+    """
+    workers = workers or os.cpu_count() or 1
+    pool: Executor
+    if processes:
+        pool = ProcessPoolExecutor(max_workers=workers,
+                                   initializer=_set_rounds,
+                                   initargs=(get_rounds(),))
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers)
+    with pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def hash_passwords_many(passwords: Iterable[str], workers: int = None,
+                        processes: bool = False) -> Iterator[bytes]:
+    """ Yields a salted, hashed password for every password, in order """
+    return _ordered_map(hash_password, passwords, workers, processes)
+
+
+def verify_many(pairs: Iterable[Tuple[bytes, str]], workers: int = None,
+                processes: bool = False) -> Iterator[bool]:
+    """ Yields is_valid for every (hashed_password, password), in order """
+    return _ordered_map(_is_valid_pair, pairs, workers, processes)
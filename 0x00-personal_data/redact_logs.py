@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+""" Scrubs PII from existing log files with the filter_datum rules """
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import mmap
+import os
+import sys
+import time
+from typing import BinaryIO, Iterator, List, Tuple
+
+from filtered_logger import PII_FIELDS, RedactingFormatter, get_redactor
+
+
+def chunk_bounds(data: mmap.mmap, chunk_size: int
+                 ) -> Iterator[Tuple[int, int]]:
+    """ Yields (start, end) offsets of chunks ending on line boundaries """
+    start, size = 0, len(data)
+    while start < size:
+        end = data.find(b'\n', min(start + chunk_size, size) - 1)
+        end = size if end == -1 else end + 1
+        yield start, end
+        start = end
+
+
+def redact_chunk(path: str, fields: List[str], redaction: str,
+                 separator: str, bounds: Tuple[int, int]) -> bytes:
+    """ Redacts the lines of path between the given offsets
+
+    A redacted value never runs past the end of its line, so the chunk
+    comes out as if each of its lines was redacted on its own. Runs in a
+    worker process, so the file is mapped again here instead of shipping
+    its content through the pool.
+    """
+    redactor = get_redactor(tuple(fields), redaction, separator)
+    start, end = bounds
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return redactor.redact(data[start:end])
+
+
+def redact_file(path: str, out: BinaryIO, fields: List[str],
+                redaction: str, separator: str, workers: int = 1,
+                chunk_size: int = 8 << 20) -> int:
+    """ Writes a redacted copy of path to out and returns its input size
+
+    Chunks are split at line boundaries; with several workers they are
+    redacted on a process pool and written back in their original order,
+    with at most two chunks per worker in flight.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return 0
+
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        bounds = chunk_bounds(data, chunk_size)
+        if workers <= 1:
+            redactor = get_redactor(tuple(fields), redaction, separator)
+            for start, end in bounds:
+                out.write(redactor.redact(data[start:end]))
+            return size
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for chunk in bounds:
+                pending.append(executor.submit(redact_chunk, path, fields,
+                                               redaction, separator, chunk))
+                if len(pending) >= workers * 2:
+                    out.write(pending.popleft().result())
+            while pending:
+                out.write(pending.popleft().result())
+    return size
+
+
+def main() -> None:
+    """ Parses the command line and redacts the input log file """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('input', help="log file to scrub")
+    parser.add_argument('output', nargs='?', default='-',
+                        help="redacted copy, '-' for stdout (default)")
+    parser.add_argument('--fields', nargs='+', default=list(PII_FIELDS))
+    parser.add_argument('--redaction', default=RedactingFormatter.REDACTION)
+    parser.add_argument('--separator', default=RedactingFormatter.SEPARATOR)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=8 << 20,
+                        help="approximate bytes per chunk")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    if args.output == '-':
+        size = redact_file(args.input, sys.stdout.buffer, args.fields,
+                           args.redaction, args.separator, args.workers,
+                           args.chunk_size)
+        sys.stdout.buffer.flush()
+    else:
+        with open(args.output, 'wb') as out:
+            size = redact_file(args.input, out, args.fields,
+                               args.redaction, args.separator,
+                               args.workers, args.chunk_size)
+    elapsed = time.perf_counter() - started
+    rate = size / (1 << 20) / elapsed if elapsed else 0.0
+    print(f"redacted {size} bytes in {elapsed:.2f}s ({rate:.1f} MB/s)",
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
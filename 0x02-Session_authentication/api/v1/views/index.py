@@ -26,6 +26,17 @@ def stats() -> str:
     return jsonify(stats)
 
 
+@app_views.route('/stats/load', strict_slashes=False)
+def load_stats() -> str:
+    """ GET /api/v1/stats/load
+    Return:
+      - the number of objects, seconds taken and lazy mode of the last
+        load of each class
+    """
+    from models.json_storage import LOAD_STATS
+    return jsonify(LOAD_STATS)
+
+
 @app_views.route('/unauthorized', strict_slashes=False)
 def not_found() -> None:
     """Raises a 401 not found error"""
@@ -9,11 +9,29 @@ from models.user import User
 @app_views.route('/users', methods=['GET'], strict_slashes=False)
 def view_all_users() -> str:
     """ GET /api/v1/users
+    Query parameters, all optional:
+      - limit: most users to return
+      - offset: users to skip
+      - cursor: X-Next-Cursor header of the previous page
     Return:
-      - list of all User objects JSON represented
+      - list of User objects JSON represented, oldest first
+      - X-Next-Cursor header when the page is full
+      - 400 if a parameter is invalid
     """
-    all_users = [user.to_json() for user in User.all()]
-    return jsonify(all_users)
+    try:
+        limit = request.args.get('limit')
+        limit = None if limit is None else int(limit)
+        offset = int(request.args.get('offset', 0))
+        users = User.iter_all(limit, offset, request.args.get('cursor'))
+    except ValueError:
+        return jsonify({'error': "invalid pagination"}), 400
+    page = []
+    for user in users:
+        page.append(user.to_json())
+    response = jsonify(page)
+    if limit is not None and limit > 0 and len(page) == limit:
+        response.headers['X-Next-Cursor'] = user.cursor()
+    return response
 
 
 @app_views.route('/users/<user_id>', methods=['GET'], strict_slashes=False)
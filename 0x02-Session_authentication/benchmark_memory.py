@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+""" Memory benchmark module
+
+Measure the resident memory held per User and UserSession in DATA, with
+and without MODELS_COMPACT. Every measurement runs in a fresh process,
+as MODELS_COMPACT is read when the models are imported and peak RSS
+only grows.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+from typing import List
+
+
+def _rss() -> int:
+    """ Return the peak resident memory of the process in bytes
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(class_name: str, count: int) -> dict:
+    """ Return the bytes per object of count objects of a class
+
+    Memory is sampled once the objects are in DATA, once their indexes
+    are built and once every object was serialized, as a save does.
+    """
+    from models.json_storage import DATA
+    from models.user import User
+    from models.user_session import UserSession
+
+    cls = User if class_name == 'User' else UserSession
+    DATA[class_name] = objs = {}
+    before = _rss()
+    for i in range(count):
+        if cls is User:
+            obj = User(email="user{}@example.com".format(i),
+                       _password="{:064x}".format(i),
+                       first_name="First{}".format(i),
+                       last_name="Last{}".format(i))
+        else:
+            obj = UserSession(user_id="{:036x}".format(i),
+                              session_id="{:036x}".format(i + count))
+        objs[obj.id] = obj
+    built = _rss()
+    cls._storage()._all_indexes(cls)
+    indexed = _rss()
+    for obj in objs.values():
+        obj.to_json(True)
+    serialized = _rss()
+    return {
+        'class': class_name,
+        'compact': cls.compact_objects,
+        'objects': count,
+        'bytes_per_object': (built - before) / count,
+        'bytes_per_object_indexed': (indexed - before) / count,
+        'bytes_per_object_serialized': (serialized - before) / count,
+    }
+
+
+def run(counts: List[int]) -> dict:
+    """ Measure every count and class in both representations
+    """
+    results = []
+    for count in counts:
+        for class_name in ('User', 'UserSession'):
+            for compact in ("0", "1"):
+                env = dict(os.environ, MODELS_COMPACT=compact)
+                output = subprocess.run(
+                    [sys.executable, __file__,
+                     '--child', class_name, str(count)],
+                    env=env, check=True, stdout=subprocess.PIPE).stdout
+                results.append(json.loads(output))
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+
+def main() -> None:
+    """ Parse the command line and write the results as JSON
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--counts', type=int, nargs='+',
+                        default=[100000, 1000000],
+                        help="objects per class (default: 100k and 1M)")
+    parser.add_argument('--output', default='-',
+                        help="JSON results file, '-' for stdout (default)")
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        json.dump(measure(args.child[0], int(args.child[1])), sys.stdout)
+        return
+    report = run(args.counts)
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,39 +1,154 @@
 #!/usr/bin/env python3
 """ Base module
 """
-from datetime import datetime
-from typing import TypeVar, List, Iterable
-from os import path
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import TypeVar, List, Iterable, Iterator, Tuple
+from os import getenv
 import json
 import uuid
 
+from models.json_storage import DATA, JSONStorage
+from models.sqlite_storage import SQLiteStorage
+from models.storage import Storage
+
 
 TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
-DATA = {}
+TIMESTAMP_ATTRIBUTES = ('created_at', 'updated_at')
+UNTRACKED_ATTRIBUTES = frozenset(('_cache',))
+EPOCH = datetime(1970, 1, 1)
+STORAGES = {}
+_setattr = object.__setattr__
+
+
+def parse_timestamp(value: str) -> datetime:
+    """ Parse a TIMESTAMP_FORMAT string, trying the fast ISO parser first
+
+    A datetime, as read from a binary snapshot, is returned unchanged.
+    """
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return datetime.strptime(value, TIMESTAMP_FORMAT)
+
+
+def parse_cursor(cursor: str) -> Tuple[datetime, str]:
+    """ Return the created_at and ID a cursor from Base.cursor holds
+    """
+    value, separator, obj_id = cursor.partition("|")
+    if not separator:
+        raise ValueError("Invalid cursor: {}".format(cursor))
+    return parse_timestamp(value), obj_id
+
+
+class EpochTimestamp():
+    """ datetime attribute stored as integer epoch seconds
+
+    The seconds live in a slot named after the attribute with a leading
+    underscore; sub-second precision is dropped, as in snapshots.
+    """
+
+    def __set_name__(self, owner: type, name: str):
+        """ Bind the descriptor to the slot of its attribute
+        """
+        self.slot = "_" + name
+
+    def __get__(self, obj, owner: type = None):
+        """ Return the stored timestamp as a datetime
+        """
+        if obj is None:
+            return self
+        return EPOCH + timedelta(seconds=getattr(obj, self.slot))
+
+    def __set__(self, obj, value: datetime):
+        """ Store a datetime as integer seconds
+        """
+        _setattr(obj, self.slot, (value - EPOCH) // timedelta(seconds=1))
+
+
+@lru_cache(maxsize=None)
+def slot_names(cls: type) -> tuple:
+    """ Return the public names of the slots of a class, bases first
+    """
+    names = []
+    for klass in reversed(cls.__mro__):
+        for name in klass.__dict__.get('__slots__', ()):
+            if name in UNTRACKED_ATTRIBUTES:
+                continue
+            if name[1:] in TIMESTAMP_ATTRIBUTES:
+                name = name[1:]
+            names.append(name)
+    return tuple(names)
 
 
 class Base():
     """ Base class
+
+    Subclasses list attributes in indexed_attributes to have equality
+    searches on them answered from a hash index instead of a scan, and
+    in sorted_attributes to back range, prefix and ordered queries.
+
+    With MODELS_COMPACT=1 Base and its subclasses use __slots__ instead
+    of an instance __dict__, and created_at and updated_at are stored as
+    integer epoch seconds, turned back into datetimes when read.
+
+    Every attribute write drops the cached serialized forms of the
+    object, which are otherwise reused by to_json and by snapshot
+    writes. The cache trades memory for speed: it holds a dict and the
+    JSON text of every object serialized, more than a compact object
+    itself takes. So it is off with MODELS_COMPACT=1 unless
+    MODELS_CACHE_JSON=1, and MODELS_CACHE_JSON=0 turns it off always.
+
+    MODELS_STORAGE picks where objects are kept: 'json' (default) holds
+    them all in DATA and saves them to .db_<Class> files, 'sqlite' keeps
+    each class in a table of the MODELS_SQLITE_PATH database and only
+    builds the objects a lookup returns. The first time a class is
+    loaded into SQLite, its files are imported. The settings of both
+    are read here, and every load, save and lookup is handed to the
+    storage; the JSON storage describes its own in models.json_storage.
     """
 
+    indexed_attributes = ()
+    sorted_attributes = ('created_at', 'updated_at')
+    journal = getenv("MODELS_JOURNAL", "0") == "1"
+    journal_max_bytes = int(getenv("MODELS_JOURNAL_MAX_BYTES", 1 << 20))
+    durability = getenv("MODELS_DURABILITY", "immediate")
+    flush_interval = float(getenv("MODELS_FLUSH_INTERVAL", 1.0))
+    flush_max_changes = int(getenv("MODELS_FLUSH_MAX_CHANGES", 100))
+    shards = int(getenv("MODELS_SHARDS", 0))
+    parallel_load_bytes = int(getenv("MODELS_PARALLEL_LOAD_BYTES", 64 << 20))
+    lazy_load = getenv("MODELS_LAZY_LOAD", "0") == "1"
+    snapshot_format = getenv("MODELS_SNAPSHOT_FORMAT", "json")
+    compact_objects = getenv("MODELS_COMPACT", "0") == "1"
+    cache_json = getenv("MODELS_CACHE_JSON",
+                        "0" if compact_objects else "1") == "1"
+    multiprocess = getenv("MODELS_MULTIPROCESS", "0") == "1"
+    sync_interval = float(getenv("MODELS_SYNC_INTERVAL", 1.0))
+    storage = getenv("MODELS_STORAGE", "json")
+    sqlite_path = getenv("MODELS_SQLITE_PATH", ".db_models.sqlite3")
+
+    if compact_objects:
+        __slots__ = ('id', '_created_at', '_updated_at', '_cache')
+        created_at = EpochTimestamp()
+        updated_at = EpochTimestamp()
+
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a Base instance
         """
+        _setattr(self, '_cache', None)
         s_class = str(self.__class__.__name__)
         if DATA.get(s_class) is None:
-            DATA[s_class] = {}
+            DATA.setdefault(s_class, {})
 
-        self.id = kwargs.get('id', str(uuid.uuid4()))
-        if kwargs.get('created_at') is not None:
-            self.created_at = datetime.strptime(kwargs.get('created_at'),
-                                                TIMESTAMP_FORMAT)
-        else:
-            self.created_at = datetime.utcnow()
-        if kwargs.get('updated_at') is not None:
-            self.updated_at = datetime.strptime(kwargs.get('updated_at'),
-                                                TIMESTAMP_FORMAT)
-        else:
-            self.updated_at = datetime.utcnow()
+        _setattr(self, 'id',
+                 kwargs['id'] if 'id' in kwargs else str(uuid.uuid4()))
+        for key in TIMESTAMP_ATTRIBUTES:
+            if kwargs.get(key) is not None:
+                _setattr(self, key, parse_timestamp(kwargs.get(key)))
+            else:
+                _setattr(self, key, datetime.utcnow())
 
     def __eq__(self, other: TypeVar('Base')) -> bool:
         """ Equality
@@ -44,11 +159,72 @@ class Base():
             return False
         return (self.id == other.id)
 
+    def __setattr__(self, name: str, value):
+        """ Set an attribute and mark the object as changed
+        """
+        _setattr(self, name, value)
+        if name not in UNTRACKED_ATTRIBUTES and self._cache is not None:
+            _setattr(self, '_cache', None)
+
+    def cursor(self) -> str:
+        """ Return the position of the object in iteration order
+
+        Passed to iter_all or iter_search, it resumes right after the
+        object.
+        """
+        return "{}|{}".format(self.created_at.isoformat(), self.id)
+
     def to_json(self, for_serialization: bool = False) -> dict:
         """ Convert the object a JSON dictionary
         """
+        return dict(self._json_view(for_serialization))
+
+    def _json_view(self, for_serialization: bool = False) -> dict:
+        """ Return the cached JSON dictionary of the object
+
+        The dictionary is shared until the object changes and must not
+        be modified. The public view is derived from the serialization
+        one when that is cached.
+        """
+        cache = self._cache
+        if cache is None:
+            cache = {}
+            if self.cache_json:
+                _setattr(self, '_cache', cache)
+        view = cache.get(for_serialization)
+        if view is not None:
+            return view
+        if not for_serialization and True in cache:
+            view = {key: value for key, value in cache[True].items()
+                    if key[0] != '_'}
+        else:
+            view = self._build_json(for_serialization)
+        cache[for_serialization] = view
+        return view
+
+    def _json_text(self) -> str:
+        """ Return the cached JSON text of the serialization view
+        """
+        view = self._json_view(True)
+        cache = self._cache
+        if cache is None:
+            return json.dumps(view)
+        if 'text' not in cache:
+            cache['text'] = json.dumps(view)
+        return cache['text']
+
+    def _build_json(self, for_serialization: bool) -> dict:
+        """ Build the JSON dictionary of the object
+        """
         result = {}
-        for key, value in self.__dict__.items():
+        if self.compact_objects:
+            items = ((key, getattr(self, key))
+                     for key in slot_names(self.__class__))
+        else:
+            items = self.__dict__.items()
+        for key, value in items:
+            if key in UNTRACKED_ATTRIBUTES:
+                continue
             if not for_serialization and key[0] == '_':
                 continue
             if type(value) is datetime:
@@ -57,56 +233,99 @@ class Base():
                 result[key] = value
         return result
 
+    @classmethod
+    def attribute_from_json(cls, obj_json: dict, attribute: str):
+        """ Return the value an attribute gets from a JSON dictionary
+
+        Lets a lazily loaded object be indexed before it is built. Raises
+        KeyError for a timestamp the dictionary lacks, which is only set
+        when the object is built.
+        """
+        value = obj_json.get(attribute)
+        if attribute in TIMESTAMP_ATTRIBUTES:
+            if value is None:
+                raise KeyError(attribute)
+            return parse_timestamp(value)
+        return value
+
     @classmethod
     def load_from_file(cls):
-        """ Load all objects from file
+        """ Load all objects from the storage of the class
         """
-        s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        DATA[s_class] = {}
-        if not path.exists(file_path):
-            return
+        cls._storage().load(cls)
 
-        with open(file_path, 'r') as f:
-            objs_json = json.load(f)
-            for obj_id, obj_json in objs_json.items():
-                DATA[s_class][obj_id] = cls(**obj_json)
+    @classmethod
+    def _storage(cls) -> Storage:
+        """ Return the storage of the class
+        """
+        storage = STORAGES.get(cls.storage)
+        if storage is None:
+            if cls.storage == "json":
+                storage = JSONStorage()
+            elif cls.storage == "sqlite":
+                storage = SQLiteStorage(cls.sqlite_path)
+            else:
+                raise ValueError("Unknown storage {}".format(cls.storage))
+            storage = STORAGES.setdefault(cls.storage, storage)
+        return storage
 
     @classmethod
     def save_to_file(cls):
         """ Save all objects to file
         """
-        s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        objs_json = {}
-        for obj_id, obj in DATA[s_class].items():
-            objs_json[obj_id] = obj.to_json(True)
+        cls._storage().save_all(cls)
 
-        with open(file_path, 'w') as f:
-            json.dump(objs_json, f)
+    @classmethod
+    def flush(cls):
+        """ Write the buffered changes of the class now
+        """
+        cls._storage().flush(cls)
+
+    @classmethod
+    def compact(cls):
+        """ Fold the changes logged since the last snapshot into a new one
+        """
+        cls._storage().compact(cls)
 
     def save(self):
         """ Save current object
         """
-        s_class = self.__class__.__name__
-        self.updated_at = datetime.utcnow()
-        DATA[s_class][self.id] = self
-        self.__class__.save_to_file()
+        self._storage().save(self)
 
     def remove(self):
         """ Remove object
         """
-        s_class = self.__class__.__name__
-        if DATA[s_class].get(self.id) is not None:
-            del DATA[s_class][self.id]
-            self.__class__.save_to_file()
+        self._storage().remove(self)
+
+    @classmethod
+    def save_many(cls, objs: Iterable[TypeVar('Base')], touch: bool = True):
+        """ Save several objects of the class with a single write
+
+        The changes are stored all at once or not at all. Without touch
+        updated_at is kept, as when importing objects.
+        """
+        batch = {}
+        for obj in objs:
+            if not isinstance(obj, cls):
+                raise TypeError("Expected {} objects".format(cls.__name__))
+            batch[obj.id] = obj
+        if batch:
+            cls._storage().save_many(cls, batch, touch)
+
+    @classmethod
+    def remove_many(cls, ids: Iterable[str]):
+        """ Remove the objects of several IDs with a single write
+
+        Unknown IDs are ignored. The removals are stored all at once or
+        not at all.
+        """
+        cls._storage().remove_many(cls, ids)
 
     @classmethod
     def count(cls) -> int:
         """ Count all objects
         """
-        s_class = cls.__name__
-        return len(DATA[s_class].keys())
+        return cls._storage().count(cls)
 
     @classmethod
     def all(cls) -> Iterable[TypeVar('Base')]:
@@ -118,20 +337,49 @@ class Base():
     def get(cls, id: str) -> TypeVar('Base'):
         """ Return one object by ID
         """
-        s_class = cls.__name__
-        return DATA[s_class].get(id)
+        return cls._storage().get(cls, id)
 
     @classmethod
     def search(cls, attributes: dict = {}) -> List[TypeVar('Base')]:
         """ Search all objects with matching attributes
         """
-        s_class = cls.__name__
-        def _search(obj):
-            if len(attributes) == 0:
-                return True
-            for k, v in attributes.items():
-                if (getattr(obj, k) != v):
-                    return False
-            return True
-        
-        return list(filter(_search, DATA[s_class].values()))
+        return cls._storage().search(cls, attributes)
+
+    @classmethod
+    def iter_all(cls, limit: int = None, offset: int = 0,
+                 cursor: str = None) -> Iterator[TypeVar('Base')]:
+        """ Iterate over all objects, as iter_search does
+        """
+        return cls.iter_search({}, limit, offset, cursor)
+
+    @classmethod
+    def iter_search(cls, attributes: dict = {}, limit: int = None,
+                    offset: int = 0,
+                    cursor: str = None) -> Iterator[TypeVar('Base')]:
+        """ Iterate over the objects with matching attributes
+
+        Objects come ordered by created_at, then ID, and are read a
+        batch at a time, so memory use does not grow with their number.
+        offset matches are skipped and at most limit are returned. A
+        cursor from the cursor method of an object resumes right after
+        it, even if it was removed since.
+        """
+        if offset < 0 or limit is not None and limit < 0:
+            raise ValueError("limit and offset must not be negative")
+        position = None if cursor is None else parse_cursor(cursor)
+        return cls._storage().iterate(cls, attributes, limit, offset,
+                                      position)
+
+    @classmethod
+    def query(cls, *conditions: tuple, order_by: str = None,
+              descending: bool = False,
+              limit: int = None) -> List[TypeVar('Base')]:
+        """ Search objects with (attribute, operator, value) conditions
+
+        Operators are ==, !=, <, <=, >, >=, in and prefix. Range and
+        prefix conditions on sorted_attributes, and ordering by one of
+        them, are answered from a sorted index; equality and in
+        conditions on indexed_attributes from a hash index.
+        """
+        return cls._storage().query(cls, list(conditions), order_by,
+                                    descending, limit)
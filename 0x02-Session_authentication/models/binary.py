@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+""" Binary snapshot module
+
+Layout, all integers little-endian:
+    magic b"BSNP", version u8
+    field count u16, then per field: name length u16, UTF-8 name
+    shape count u16, then per shape: field count u16, then per field:
+        field index u16, type tag u8
+    block count u32, then per block: payload length u32, payload
+A block holds up to BLOCK_RECORDS consecutive records sharing a shape,
+that is the same fields with the same types. Its payload is the shape
+index u16 and the record count u32, then one column per field: numbers
+packed back to back, strings as one UTF-8 run joined by NUL bytes and
+prefixed by its length u32. Timestamps are stored as integer seconds
+since the epoch. Decoding a block is a few struct calls and one string
+split per column rather than work per value.
+"""
+import argparse
+from datetime import datetime, timedelta
+from itertools import repeat
+import json
+import mmap
+import os
+import struct
+import threading
+from typing import Iterator, List, Tuple
+
+from models.journal import fsync_directory, write_json_atomic
+
+
+EPOCH = datetime(1970, 1, 1)
+MAGIC = b"BSNP"
+VERSION = 1
+BLOCK_RECORDS = 4096
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+TIMESTAMP_FIELDS = ('created_at', 'updated_at')
+
+T_NONE, T_STR, T_INT, T_FLOAT, T_BOOL, T_TIMESTAMP, T_JSON = range(7)
+NUMBER_FORMATS = {T_INT: "q", T_FLOAT: "d", T_BOOL: "?", T_TIMESTAMP: "q"}
+TEXT_TAGS = (T_STR, T_JSON)
+
+_U8 = struct.Struct("<B")
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+_BLOCK = struct.Struct("<IHI")
+_FIELD = struct.Struct("<HB")
+
+
+def _tag_of(key: str, value, seconds: dict) -> Tuple[int, object]:
+    """ Return the type tag of a value and the value to store
+
+    seconds caches the epoch seconds of each timestamp already seen.
+    """
+    if value is None:
+        return T_NONE, None
+    if key in TIMESTAMP_FIELDS and isinstance(value, (str, datetime)):
+        if value not in seconds:
+            moment = value
+            if isinstance(moment, str):
+                try:
+                    moment = datetime.fromisoformat(moment)
+                except ValueError:
+                    moment = datetime.strptime(moment, TIMESTAMP_FORMAT)
+            seconds[value] = (moment - EPOCH) // timedelta(seconds=1)
+        return T_TIMESTAMP, seconds[value]
+    if isinstance(value, bool):
+        return T_BOOL, value
+    if isinstance(value, int) and -(1 << 63) <= value < (1 << 63):
+        return T_INT, value
+    if isinstance(value, float):
+        return T_FLOAT, value
+    if isinstance(value, str) and "\0" not in value:
+        return T_STR, value
+    return T_JSON, json.dumps(value)
+
+
+def _encode_block(shape: tuple, index: int, rows: List[list]) -> bytes:
+    """ Return one block of rows, stored column by column
+    """
+    payload = bytearray(_U16.pack(index) + _U32.pack(len(rows)))
+    for i, (_, tag) in enumerate(shape):
+        if tag in NUMBER_FORMATS:
+            payload += struct.pack("<{}{}".format(
+                len(rows), NUMBER_FORMATS[tag]), *(row[i] for row in rows))
+        elif tag in TEXT_TAGS:
+            encoded = "\0".join(row[i] for row in rows).encode()
+            payload += _U32.pack(len(encoded)) + encoded
+    return _U32.pack(len(payload)) + payload
+
+
+def encode(objs_json: dict) -> bytes:
+    """ Return the binary snapshot of serialized objects keyed by ID
+    """
+    fields = {}
+    shapes = {}
+    seconds = {}
+    blocks = []
+    current, rows = None, []
+    for obj_json in objs_json.values():
+        shape, row = [], []
+        for key, value in obj_json.items():
+            tag, value = _tag_of(key, value, seconds)
+            shape.append((fields.setdefault(key, len(fields)), tag))
+            row.append(value)
+        shape = tuple(shape)
+        if shape != current or len(rows) == BLOCK_RECORDS:
+            if rows:
+                blocks.append(_encode_block(current, shapes[current], rows))
+            current, rows = shape, []
+            shapes.setdefault(shape, len(shapes))
+        rows.append(row)
+    if rows:
+        blocks.append(_encode_block(current, shapes[current], rows))
+
+    header = bytearray(MAGIC) + _U8.pack(VERSION) + _U16.pack(len(fields))
+    for key in fields:
+        encoded = key.encode()
+        header += _U16.pack(len(encoded)) + encoded
+    header += _U16.pack(len(shapes))
+    for shape in shapes:
+        header += _U16.pack(len(shape))
+        for index, tag in shape:
+            header += _FIELD.pack(index, tag)
+    header += _U32.pack(len(blocks))
+    return b"".join([bytes(header)] + blocks)
+
+
+def _moments(column: tuple, moments: dict) -> List[datetime]:
+    """ Return the datetimes of a column of epoch seconds
+
+    Each distinct value is converted once and cached in moments, as
+    records written together mostly share their timestamps.
+    """
+    for seconds in set(column).difference(moments):
+        moments[seconds] = EPOCH + timedelta(seconds=seconds)
+    return list(map(moments.__getitem__, column))
+
+
+def _decode_block(data, offset: int, names: List[str], tags: List[int],
+                  moments: dict) -> List[dict]:
+    """ Return the records of the block whose columns start at offset
+    """
+    count = _U32.unpack_from(data, offset)[0]
+    offset += 4
+    columns = []
+    for tag in tags:
+        if tag in NUMBER_FORMATS:
+            column_format = "<{}{}".format(count, NUMBER_FORMATS[tag])
+            column = struct.unpack_from(column_format, data, offset)
+            offset += struct.calcsize(column_format)
+            if tag == T_TIMESTAMP:
+                column = _moments(column, moments)
+        elif tag in TEXT_TAGS:
+            length = _U32.unpack_from(data, offset)[0]
+            column = data[offset + 4:offset + 4 + length].decode().split("\0")
+            offset += 4 + length
+            if tag == T_JSON:
+                column = list(map(json.loads, column))
+        else:
+            column = repeat(None, count)
+        columns.append(column)
+    return [dict(zip(names, row)) for row in zip(*columns)]
+
+
+def decode_records(data) -> Iterator[dict]:
+    """ Yield every record of a binary snapshot held in a buffer
+
+    Timestamps come back as datetime objects and field names are the
+    shared strings of the field table.
+    """
+    if bytes(data[:4]) != MAGIC:
+        raise ValueError("Not a binary snapshot")
+    if data[4] != VERSION:
+        raise ValueError("Unsupported snapshot version {}".format(data[4]))
+    offset = 5
+    fields = []
+    for _ in range(_U16.unpack_from(data, offset)[0]):
+        length = _U16.unpack_from(data, offset + 2)[0]
+        fields.append(bytes(data[offset + 4:offset + 4 + length]).decode())
+        offset += 2 + length
+    offset += 2
+
+    shapes = []
+    for _ in range(_U16.unpack_from(data, offset)[0]):
+        count = _U16.unpack_from(data, offset + 2)[0]
+        entries = [_FIELD.unpack_from(data, offset + 4 + 3 * i)
+                   for i in range(count)]
+        shapes.append(([fields[index] for index, _ in entries],
+                       [tag for _, tag in entries]))
+        offset += 2 + 3 * count
+    offset += 2
+
+    blocks = _U32.unpack_from(data, offset)[0]
+    offset += 4
+    moments = {}
+    for _ in range(blocks):
+        length, shape, _ = _BLOCK.unpack_from(data, offset)
+        names, tags = shapes[shape]
+        yield from _decode_block(data, offset + 6, names, tags, moments)
+        offset += 4 + length
+
+
+def iter_binary(file_path: str) -> Iterator[dict]:
+    """ Yield the records of a binary snapshot file, a block at a time
+
+    The file is read through a memory map rather than loaded at once.
+    """
+    if os.path.getsize(file_path) == 0:
+        return
+    with open(file_path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        yield from decode_records(data)
+
+
+def read_binary(file_path: str) -> dict:
+    """ Return the records of a binary snapshot file keyed by ID
+    """
+    return {record['id']: record for record in iter_binary(file_path)}
+
+
+def write_binary_atomic(file_path: str, objs_json: dict,
+                        commit: bool = True) -> str:
+    """ Write a binary snapshot through a temporary file and a rename
+
+    The file and then its directory are synced, as by write_json_atomic.
+    Without commit the rename is left to the caller and the temporary
+    path is returned.
+    """
+    tmp_path = "{}.tmp{}-{}".format(file_path, os.getpid(),
+                                    threading.get_ident())
+    with open(tmp_path, 'wb') as f:
+        f.write(encode(objs_json))
+        f.flush()
+        os.fsync(f.fileno())
+    if commit:
+        os.replace(tmp_path, file_path)
+        fsync_directory(file_path)
+    return tmp_path
+
+
+def _jsonable(record: dict) -> dict:
+    """ Return a record with its timestamps formatted back to strings
+    """
+    return {key: value.strftime(TIMESTAMP_FORMAT)
+            if isinstance(value, datetime) else value
+            for key, value in record.items()}
+
+
+def main():
+    """ Convert snapshot files between the JSON and binary formats
+    """
+    parser = argparse.ArgumentParser(description="Convert model snapshots")
+    parser.add_argument('direction', choices=('to-binary', 'to-json'))
+    parser.add_argument('source')
+    parser.add_argument('destination')
+    args = parser.parse_args()
+
+    if args.direction == 'to-binary':
+        with open(args.source, 'r') as f:
+            write_binary_atomic(args.destination, json.load(f))
+    else:
+        records = read_binary(args.source)
+        write_json_atomic(args.destination,
+                          {obj_id: _jsonable(record)
+                           for obj_id, record in records.items()})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+""" Coherence module
+
+Lets several processes share the files of a class. Writers hold an
+advisory lock on .db_<Class>.lock and bump the counter in
+.db_<Class>.gen after each write; the other processes compare that
+counter with the last one they saw to notice they are behind, then the
+signatures of the files to tell what they need to read again.
+"""
+import fcntl
+import os
+import threading
+from typing import Optional, Tuple
+
+
+def file_signature(file_path: str) -> Optional[Tuple[int, int, int]]:
+    """ Return the inode, size and modification time of a file, if any
+    """
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class FileLock():
+    """ Exclusive advisory lock on a file, shared by every process
+
+    The lock is reentrant within a process, whose threads take turns.
+    The file is opened anew by every outermost acquire, so a process
+    forked while not holding the lock never shares it with its parent.
+    """
+
+    def __init__(self, file_path: str):
+        """ Initialize a FileLock for a file path
+        """
+        self.path = file_path
+        self.local_lock = threading.RLock()
+        self.fd = None
+        self.depth = 0
+
+    def __enter__(self):
+        """ Wait until no other thread or process holds the lock
+        """
+        self.local_lock.acquire()
+        if not self.depth:
+            try:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                except BaseException:
+                    os.close(fd)
+                    raise
+            except BaseException:
+                self.local_lock.release()
+                raise
+            self.fd = fd
+        self.depth += 1
+
+    def __exit__(self, *exc_info):
+        """ Release one hold of the calling thread
+        """
+        self.depth -= 1
+        if not self.depth:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+        self.local_lock.release()
+
+
+class StoreState():
+    """ What one process last saw of the files of a class
+
+    seen is the generation the objects in memory match, files the
+    signatures of the snapshot files then, and journal and offset the
+    signature of the journal and how far it was replayed.
+    """
+
+    def __init__(self, lock_path: str, generation_path: str):
+        """ Initialize a StoreState that saw nothing yet
+        """
+        self.lock = FileLock(lock_path)
+        self.generation_path = generation_path
+        self.seen = None
+        self.files = {}
+        self.journal = None
+        self.offset = 0
+        self.next_check = 0.0
+
+    def generation(self) -> int:
+        """ Return the generation on disk, 0 before the first write
+        """
+        try:
+            with open(self.generation_path, 'r') as f:
+                return int(f.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def bump(self) -> int:
+        """ Increment the generation on disk and return it
+
+        Must be called with the lock held. The counter is replaced
+        atomically so processes reading it without the lock never see
+        a partial value.
+        """
+        generation = self.generation() + 1
+        tmp_path = "{}.tmp{}".format(self.generation_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(str(generation))
+        os.replace(tmp_path, self.generation_path)
+        return generation
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+""" Index module
+"""
+from bisect import bisect_left, bisect_right
+from typing import Any, Callable, Iterable, Iterator, List, Tuple
+
+
+class HashIndex():
+    """ Equality index mapping an attribute value to object IDs
+
+    IDs are kept in dicts used as ordered sets so lookups return objects
+    in the order they were indexed; a value held by a single object maps
+    straight to its ID, sparing a dict per value of unique attributes. A
+    key function can index a value computed from the object instead of
+    the attribute.
+    """
+
+    def __init__(self, attribute: str, key: Callable = None):
+        """ Initialize an empty index on an attribute
+        """
+        self.attribute = attribute
+        self.key = key
+        self.entries = {}
+        self.values = {}
+
+    def indexed_value(self, obj):
+        """ Return the indexed value of an object
+        """
+        if self.key is not None:
+            return self.key(obj)
+        return getattr(obj, self.attribute, None)
+
+    def add(self, obj):
+        """ Index an object, moving it if its value changed
+        """
+        value = self.indexed_value(obj)
+        if obj.id in self.values:
+            if self.values[obj.id] == value:
+                return
+            self.discard(obj.id)
+        self._insert(obj.id, value)
+
+    def _insert(self, obj_id: str, value):
+        """ Index an ID not indexed yet under a value
+        """
+        ids = self.entries.get(value)
+        if ids is None:
+            self.entries[value] = obj_id
+        elif type(ids) is dict:
+            ids[obj_id] = None
+        else:
+            self.entries[value] = {ids: None, obj_id: None}
+        self.values[obj_id] = value
+
+    def discard(self, obj_id: str):
+        """ Remove an object from the index
+        """
+        if obj_id not in self.values:
+            return
+        value = self.values.pop(obj_id)
+        ids = self.entries[value]
+        if type(ids) is not dict:
+            del self.entries[value]
+            return
+        del ids[obj_id]
+        if len(ids) == 1:
+            self.entries[value] = next(iter(ids))
+
+    def lookup(self, value) -> Iterable[str]:
+        """ Return the IDs of the objects indexed with a value
+        """
+        ids = self.entries.get(value)
+        if ids is None:
+            return ()
+        if type(ids) is dict:
+            return ids.keys()
+        return (ids,)
+
+    def add_many(self, objs: Iterable):
+        """ Index several objects
+        """
+        for obj in objs:
+            self.add(obj)
+
+    def discard_many(self, obj_ids: Iterable[str]):
+        """ Remove several objects from the index
+        """
+        for obj_id in obj_ids:
+            self.discard(obj_id)
+
+    def rebuild(self, objs: Iterable):
+        """ Replace the content of the index with objs
+        """
+        self.rebuild_values((obj.id, self.indexed_value(obj))
+                            for obj in objs)
+
+    def rebuild_values(self, items: Iterable[Tuple[str, Any]]):
+        """ Replace the content of the index with (ID, value) pairs
+        """
+        self.entries = {}
+        self.values = {}
+        for obj_id, value in items:
+            self._insert(obj_id, value)
+
+
+class SortedIndex():
+    """ Ordered index answering range and prefix lookups
+
+    keys holds (value, id) pairs in order and sorted_values the matching
+    values, so both exact removal and range bounds are binary searches.
+    Objects whose value is None are tracked but kept out of the order.
+    A key function can index a value computed from the object instead of
+    the attribute, with convert mapping range bounds to the same order.
+    """
+
+    def __init__(self, attribute: str, key: Callable = None,
+                 convert: Callable = None):
+        """ Initialize an empty index on an attribute
+        """
+        self.attribute = attribute
+        self.key = key
+        self.convert = convert
+        self.keys = []
+        self.sorted_values = []
+        self.values = {}
+
+    def indexed_value(self, obj):
+        """ Return the indexed value of an object
+        """
+        if self.key is not None:
+            return self.key(obj)
+        return getattr(obj, self.attribute, None)
+
+    def add(self, obj):
+        """ Index an object, moving it if its value changed
+        """
+        value = self.indexed_value(obj)
+        if obj.id in self.values:
+            if self.values[obj.id] == value:
+                return
+            self.discard(obj.id)
+        self.values[obj.id] = value
+        if value is None:
+            return
+        i = bisect_right(self.keys, (value, obj.id))
+        self.keys.insert(i, (value, obj.id))
+        self.sorted_values.insert(i, value)
+
+    def discard(self, obj_id: str):
+        """ Remove an object from the index
+        """
+        if obj_id not in self.values:
+            return
+        value = self.values.pop(obj_id)
+        if value is None:
+            return
+        i = bisect_left(self.keys, (value, obj_id))
+        if i < len(self.keys) and self.keys[i] == (value, obj_id):
+            del self.keys[i]
+            del self.sorted_values[i]
+
+    def add_many(self, objs: Iterable):
+        """ Index several objects, merging them into the order in one pass
+        """
+        stale = set()
+        entries = []
+        for obj in objs:
+            value = self.indexed_value(obj)
+            if obj.id in self.values:
+                old = self.values[obj.id]
+                if old == value:
+                    continue
+                if old is not None:
+                    stale.add((old, obj.id))
+            self.values[obj.id] = value
+            if value is not None:
+                entries.append((value, obj.id))
+        if stale or entries:
+            self._merge(stale, entries)
+
+    def discard_many(self, obj_ids: Iterable[str]):
+        """ Remove several objects from the index in one pass
+        """
+        stale = set()
+        for obj_id in obj_ids:
+            if obj_id in self.values:
+                value = self.values.pop(obj_id)
+                if value is not None:
+                    stale.add((value, obj_id))
+        if stale:
+            self._merge(stale, [])
+
+    def _merge(self, stale: set, entries: list):
+        """ Drop the stale keys and merge sorted entries into the order
+        """
+        keys = [key for key in self.keys if key not in stale] \
+            if stale else self.keys[:]
+        entries.sort()
+        keys.extend(entries)
+        keys.sort()
+        self.keys = keys
+        self.sorted_values = [value for value, _ in keys]
+
+    def range(self, low=None, high=None, include_low: bool = True,
+              include_high: bool = True,
+              descending: bool = False) -> Iterator[str]:
+        """ Yield the IDs with a value between low and high, in order
+        """
+        start, end = 0, len(self.keys)
+        if self.convert is not None:
+            low = None if low is None else self.convert(low)
+            high = None if high is None else self.convert(high)
+        if low is not None:
+            start = (bisect_left if include_low else bisect_right)(
+                self.sorted_values, low)
+        if high is not None:
+            end = (bisect_right if include_high else bisect_left)(
+                self.sorted_values, high)
+        positions = range(start, end)
+        if descending:
+            positions = reversed(positions)
+        for i in positions:
+            yield self.keys[i][1]
+
+    def prefix(self, prefix: str,
+               descending: bool = False) -> Iterator[str]:
+        """ Yield the IDs of string values starting with prefix, in order
+        """
+        if not prefix:
+            return self.range(descending=descending)
+        high = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return self.range(prefix, high, include_high=False,
+                          descending=descending)
+
+    def after(self, value, obj_id: str, count: int) -> List[str]:
+        """ Return up to count IDs following the key (value, obj_id)
+
+        Without a value the IDs are taken from the start of the order.
+        The key need not be in the index any more.
+        """
+        start = 0
+        if value is not None:
+            if self.convert is not None:
+                value = self.convert(value)
+            start = bisect_right(self.keys, (value, obj_id))
+        return [key[1] for key in self.keys[start:start + count]]
+
+    def ordered(self, descending: bool = False) -> Iterator[str]:
+        """ Yield every ID in order, the ones without a value last
+        """
+        yield from self.range(descending=descending)
+        for obj_id, value in self.values.items():
+            if value is None:
+                yield obj_id
+
+    def rebuild(self, objs: Iterable):
+        """ Replace the content of the index with objs
+        """
+        self.rebuild_values((obj.id, self.indexed_value(obj))
+                            for obj in objs)
+
+    def rebuild_values(self, items: Iterable[Tuple[str, Any]]):
+        """ Replace the content of the index with (ID, value) pairs
+        """
+        entries = []
+        self.values = {}
+        for obj_id, value in items:
+            self.values[obj_id] = value
+            if value is not None:
+                entries.append((value, obj_id))
+        entries.sort()
+        self.keys = entries
+        self.sorted_values = [value for value, _ in entries]
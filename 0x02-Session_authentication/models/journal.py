@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+""" Journal module
+"""
+import json
+import os
+import threading
+from typing import Iterator, List, Tuple
+
+
+class Journal():
+    """ Append-only log of save and remove operations of one class
+
+    Each line is one JSON operation. A line torn by a crash is skipped
+    on replay, and replaying a journal twice gives the same state, so
+    operations can safely overlap the snapshot they are replayed over.
+    A batch operation holds several operations on a single line, so
+    they are replayed all or not at all.
+    """
+
+    def __init__(self, file_path: str):
+        """ Initialize a Journal for a file path
+        """
+        self.path = file_path
+        self.old_path = file_path + ".old"
+        self.lock = threading.Lock()
+        self.compaction = threading.Lock()
+        self.compacting = False
+
+    def append(self, operations: List[dict]) -> int:
+        """ Append operations and return the journal size in bytes
+        """
+        lines = "".join(json.dumps(op) + "\n" for op in operations)
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(lines)
+                return f.tell()
+
+    def rotate(self):
+        """ Move the journal aside so it can be folded into a snapshot
+
+        Must be called with the lock held. A journal left aside by an
+        interrupted compaction is kept and extended, not overwritten.
+        """
+        if not os.path.exists(self.path):
+            return
+        if not os.path.exists(self.old_path):
+            os.replace(self.path, self.old_path)
+            return
+        with open(self.path, 'r') as src, open(self.old_path, 'a') as dst:
+            dst.write(src.read())
+        os.remove(self.path)
+
+    def discard_old(self):
+        """ Remove the journal folded into the latest snapshot
+        """
+        if os.path.exists(self.old_path):
+            os.remove(self.old_path)
+
+    def replay(self) -> Iterator[dict]:
+        """ Yield every operation, oldest first
+        """
+        for file_path in (self.old_path, self.path):
+            if not os.path.exists(file_path):
+                continue
+            with open(file_path, 'r') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+
+    def tail(self, offset: int) -> Tuple[List[dict], int]:
+        """ Return the operations past a byte offset and the new offset
+
+        Only complete lines are read, so a line still being appended is
+        picked up by the next call.
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return [], offset
+        data = data[:data.rfind(b"\n") + 1]
+        operations = []
+        for line in data.splitlines():
+            try:
+                operations.append(json.loads(line))
+            except ValueError:
+                continue
+        return operations, offset + len(data)
+
+
+def fsync_directory(file_path: str):
+    """ Make the renames to a file durable by syncing its directory
+    """
+    fd = os.open(os.path.dirname(file_path) or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_json_atomic(file_path: str, data: dict, encoded: bool = False,
+                      commit: bool = True) -> str:
+    """ Write data as JSON through a temporary file and a rename
+
+    Each top-level entry goes on its own line so large files can be
+    split at line boundaries when they are read back. With encoded, the
+    values of data are JSON text already. The file is synced before the
+    rename and the directory after it, so even a power loss leaves the
+    old or the new file. Without commit the rename is left to the
+    caller and the temporary path is returned.
+    """
+    tmp_path = "{}.tmp{}-{}".format(file_path, os.getpid(),
+                                    threading.get_ident())
+    encode = str if encoded else json.dumps
+    with open(tmp_path, 'w') as f:
+        f.write("{\n")
+        f.write(",\n".join("{}: {}".format(json.dumps(key), encode(value))
+                           for key, value in data.items()))
+        f.write("\n}")
+        f.flush()
+        os.fsync(f.fileno())
+    if commit:
+        os.replace(tmp_path, file_path)
+        fsync_directory(file_path)
+    return tmp_path
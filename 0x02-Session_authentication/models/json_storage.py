@@ -0,0 +1,963 @@
+#!/usr/bin/env python3
+""" JSON storage module
+"""
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from functools import partial
+from itertools import islice
+from operator import attrgetter
+from os import path
+import atexit
+import logging
+import os
+import threading
+import time
+from typing import Callable, Iterable, Iterator, List, Tuple, TypeVar
+
+from models.binary import read_binary, write_binary_atomic
+from models.coherence import StoreState, file_signature
+from models.index import HashIndex, SortedIndex
+from models.journal import Journal, fsync_directory, write_json_atomic
+from models.loader import LazyObjects, read_snapshot
+from models.locks import ReadWriteLock
+from models.query import run_query
+from models.shards import read_json, read_shards, shard_of, shard_path, \
+    shard_paths
+from models.storage import Storage
+from models.write_behind import WriteBehind
+
+
+TIMESTAMP_ATTRIBUTES = ('created_at', 'updated_at')
+EPOCH = datetime(1970, 1, 1)
+ITERATION_BATCH = 500
+DATA = {}
+INDEXES = {}
+SORTED_INDEXES = {}
+SHARD_INDEXES = {}
+JOURNALS = {}
+WRITERS = {}
+LOCKS = {}
+BUILD_LOCKS = {}
+STATES = {}
+LOAD_STATS = {}
+logger = logging.getLogger("models")
+_unlocked = nullcontext()
+
+
+def _matches(obj, attributes: dict) -> bool:
+    """ Return whether the attributes of obj have the given values
+    """
+    for k, v in attributes.items():
+        if (getattr(obj, k) != v):
+            return False
+    return True
+
+
+def batch_operations(entries: Iterable[dict]) -> Iterable[dict]:
+    """ Yield the operations of journal entries, expanding batches
+    """
+    for entry in entries:
+        if entry.get('op') == 'batch':
+            yield from entry['ops']
+        else:
+            yield entry
+
+
+def to_epoch(value: datetime) -> float:
+    """ Return the seconds from the epoch to a naive UTC datetime
+    """
+    return (value - EPOCH).total_seconds()
+
+
+def _attribute_from_json(cls: type, attribute: str, obj_id: str,
+                         obj_json: dict):
+    """ Return the value of an attribute in the raw dict of an object
+    """
+    return cls.attribute_from_json(obj_json, attribute)
+
+
+def _epoch_seconds_from_json(cls: type, attribute: str, obj_id: str,
+                             obj_json: dict) -> int:
+    """ Return a timestamp of a raw dict as compact objects store it
+    """
+    value = cls.attribute_from_json(obj_json, attribute)
+    return (value - EPOCH) // timedelta(seconds=1)
+
+
+class JSONStorage(Storage):
+    """ Storage keeping every object in DATA, saved to .db_<Class> files
+
+    The default storage. Its settings are the class attributes Base
+    reads from the environment.
+
+    With MODELS_JOURNAL=1, save and remove append one record to
+    .db_<Class>.journal instead of rewriting .db_<Class>.json, and the
+    journal is folded into a new snapshot in the background once it
+    grows past MODELS_JOURNAL_MAX_BYTES.
+
+    MODELS_DURABILITY picks when changes reach the disk: 'immediate'
+    (default) on every save and remove, 'interval' in the background at
+    most every MODELS_FLUSH_INTERVAL seconds or after
+    MODELS_FLUSH_MAX_CHANGES changes, 'shutdown' only on flush() and at
+    exit. Snapshot files are always written aside, synced to disk and
+    renamed into place, so even a power loss leaves the old or the new.
+
+    With MODELS_SHARDS=N the snapshot is spread over N files by a hash
+    of the ID, so a write rewrites one shard and shards load in
+    parallel. The shards a batch rewrites are committed together
+    through a .db_<Class>.commit record, see _write_files. A snapshot
+    in the other layout, or with another shard count, is migrated on
+    first load, so MODELS_SHARDS can be changed or unset without
+    losing objects.
+
+    Snapshots over MODELS_PARALLEL_LOAD_BYTES are parsed in chunks on
+    worker processes. With MODELS_LAZY_LOAD=1 objects are only built
+    from their raw dict when first accessed, and indexes on first use,
+    from the raw dicts of the objects not built yet.
+
+    With MODELS_SNAPSHOT_FORMAT=binary snapshots are written in the
+    compact format of models.binary as .bin files; a JSON snapshot is
+    still read until the next write replaces it.
+
+    DATA is guarded by a reader/writer lock per class: searches and
+    queries share it, while writers are serialized and only exclude
+    readers while they change DATA and the indexes, not while they
+    write files.
+
+    With MODELS_MULTIPROCESS=1 several processes, such as the workers of
+    a pre-fork server, share the files of a class. Writes hold an
+    advisory lock on .db_<Class>.lock, first catch up with the other
+    processes and then bump the generation in .db_<Class>.gen. Reads
+    check that generation at most every MODELS_SYNC_INTERVAL seconds
+    and only read again what changed: the end of the journal, the
+    rewritten shards, or else the whole snapshot. Changes are written
+    immediately whatever MODELS_DURABILITY.
+    """
+
+    def read_files(self, cls: type) -> list:
+        """ Return the objects in the files of the class
+
+        Lets another storage import what the JSON storage left behind.
+        DATA is left empty.
+        """
+        s_class = cls.__name__
+        lock = self._lock(cls)
+        with lock.update(), self._journal(cls).compaction, lock.write():
+            self._load(cls)
+            objs = list(DATA[s_class].values())
+            DATA[s_class] = {}
+            for registry in (INDEXES, SORTED_INDEXES, SHARD_INDEXES):
+                registry.pop(s_class, None)
+        return objs
+
+    def _load(self, cls: type):
+        """ Replace the objects of the class with the ones on disk
+        """
+        started = time.perf_counter()
+        s_class = cls.__name__
+        self._finish_commit(cls)
+        file_paths, file_path = self._snapshot_files(cls)
+
+        objs_json = {}
+        if file_paths:
+            reader = read_binary if file_paths[0].endswith(".bin") \
+                else read_json
+            for shard_json in read_shards(file_paths, reader):
+                objs_json.update(shard_json)
+        elif file_path is not None and file_path.endswith(".bin"):
+            objs_json = read_binary(file_path)
+        elif file_path is not None:
+            objs_json = read_snapshot(file_path, cls.parallel_load_bytes)
+
+        if cls.lazy_load:
+            DATA[s_class] = LazyObjects(cls, objs_json)
+        else:
+            DATA[s_class] = {obj_id: cls(**obj_json)
+                             for obj_id, obj_json in objs_json.items()}
+
+        if cls.journal:
+            for op in batch_operations(self._journal(cls).replay()):
+                if op.get('op') == 'save':
+                    DATA[s_class][op['id']] = cls(**op['obj'])
+                elif op.get('op') == 'remove':
+                    DATA[s_class].pop(op['id'], None)
+
+        self._migrate(cls, file_paths, file_path)
+
+        for registry in (INDEXES, SORTED_INDEXES, SHARD_INDEXES):
+            registry.pop(s_class, None)
+        if not cls.lazy_load:
+            self._all_indexes(cls)
+
+        LOAD_STATS[s_class] = {
+            'objects': len(DATA[s_class]),
+            'seconds': time.perf_counter() - started,
+            'lazy': cls.lazy_load,
+        }
+        logger.info("Loaded %d %s objects in %.3fs", len(DATA[s_class]),
+                    s_class, LOAD_STATS[s_class]['seconds'])
+
+    def _snapshot_files(self, cls: type) -> Tuple[List[str], str]:
+        """ Return the shard files of the snapshot, or else its file
+
+        Each is looked for in the current format first. Shards are found
+        whether or not sharding is on; when both layouts exist the one
+        of the current mode wins. Missing files give [] and None.
+        """
+        s_class = cls.__name__
+        file_paths, file_path = [], None
+        for ext in self._extensions(cls):
+            if not file_paths:
+                file_paths = shard_paths(s_class, ext)
+            candidate = ".db_{}.{}".format(s_class, ext)
+            if file_path is None and path.exists(candidate):
+                file_path = candidate
+        if file_paths and (cls.shards or file_path is None):
+            return file_paths, None
+        return [], file_path
+
+    def _migrate(self, cls: type, file_paths: List[str], file_path: str):
+        """ Rewrite a snapshot loaded from another layout as the current
+
+        Shards of another count or format and a single file in sharded
+        mode, or shards otherwise, are rewritten in the current layout.
+        Files of another layout, loaded or left over, are then kept
+        aside with a .migrated suffix so they are not read again.
+        """
+        s_class = cls.__name__
+        others = [shard for ext in self._extensions(cls)
+                  for shard in shard_paths(s_class, ext)]
+        if cls.shards:
+            current = {self._shard_path(cls, shard)
+                       for shard in range(cls.shards)}
+            others = [other for other in others if other not in current]
+            others += [other for other in (".db_{}.{}".format(s_class, ext)
+                                           for ext in self._extensions(cls))
+                       if path.exists(other)]
+        loaded = set(file_paths)
+        if file_path is not None:
+            loaded.add(file_path)
+        if loaded.intersection(others):
+            self._save_all(cls)
+        for other in others:
+            os.replace(other, other + ".migrated")
+
+    def _lock(self, cls: type) -> ReadWriteLock:
+        """ Return the reader/writer lock of the class
+        """
+        s_class = cls.__name__
+        lock = LOCKS.get(s_class)
+        if lock is None:
+            lock = LOCKS.setdefault(s_class, ReadWriteLock())
+        return lock
+
+    def _build_lock(self, cls: type) -> threading.Lock:
+        """ Return the lock serializing the lazy builds of the indexes
+        """
+        s_class = cls.__name__
+        lock = BUILD_LOCKS.get(s_class)
+        if lock is None:
+            lock = BUILD_LOCKS.setdefault(s_class, threading.Lock())
+        return lock
+
+    def _state(self, cls: type) -> StoreState:
+        """ Return what this process last saw of the files of the class
+        """
+        s_class = cls.__name__
+        state = STATES.get(s_class)
+        if state is None:
+            state = STATES.setdefault(s_class, StoreState(
+                ".db_{}.lock".format(s_class), ".db_{}.gen".format(s_class)))
+        return state
+
+    def _store_lock(self, cls: type):
+        """ Return the lock shared with other processes, if any
+
+        It is taken after the update lock and before the write lock.
+        """
+        if not cls.multiprocess:
+            return _unlocked
+        return self._state(cls).lock
+
+    def _signatures(self, cls: type) -> dict:
+        """ Return the signatures of the snapshot files on disk by path
+        """
+        s_class = cls.__name__
+        file_paths = [self._journal(cls).old_path]
+        for ext in ("json", "bin"):
+            file_paths.append(".db_{}.{}".format(s_class, ext))
+            file_paths.extend(shard_paths(s_class, ext))
+        signatures = {}
+        for file_path in file_paths:
+            signature = file_signature(file_path)
+            if signature is not None:
+                signatures[file_path] = signature
+        return signatures
+
+    def _remember(self, cls: type, generation: int):
+        """ Record that memory matches the files of a generation
+
+        Must be called with the store lock held.
+        """
+        if not cls.multiprocess:
+            return
+        state = self._state(cls)
+        state.seen = generation
+        state.files = self._signatures(cls)
+        state.journal = file_signature(self._journal(cls).path)
+        state.offset = state.journal[1] if state.journal else 0
+
+    def _publish(self, cls: type):
+        """ Tell other processes the files changed
+
+        Must be called with the store lock held, after a write.
+        """
+        if cls.multiprocess:
+            self._remember(cls, self._state(cls).bump())
+
+    def _refresh(self, cls: type):
+        """ Catch up with other processes if the interval elapsed
+        """
+        if not cls.multiprocess:
+            return
+        state = self._state(cls)
+        now = time.monotonic()
+        if now < state.next_check:
+            return
+        state.next_check = now + cls.sync_interval
+        if state.generation() != state.seen:
+            with state.lock:
+                self._sync(cls)
+
+    def _sync(self, cls: type):
+        """ Read again what other processes changed on disk
+
+        Must be called with the store lock held. In journal mode only
+        the lines appended since the last sync are replayed, unless a
+        compaction replaced the files. Sharded snapshots reload the
+        shards whose signature changed. Anything else reloads it all.
+        """
+        if not cls.multiprocess:
+            return
+        state = self._state(cls)
+        generation = state.generation()
+        if generation == state.seen:
+            return
+        files = self._signatures(cls)
+        with self._lock(cls).write():
+            if state.seen is None:
+                self._load(cls)
+            elif cls.journal:
+                journal = file_signature(self._journal(cls).path)
+                if files == state.files and (
+                        state.journal is None or journal is not None and
+                        journal[0] == state.journal[0] and
+                        journal[1] >= state.offset):
+                    operations, _ = self._journal(cls).tail(state.offset)
+                    self._apply(cls, batch_operations(operations))
+                else:
+                    self._load(cls)
+            elif not cls.shards or not self._reload_shards(
+                    cls, state.files, files):
+                self._load(cls)
+        self._remember(cls, generation)
+
+    def _apply(self, cls: type, operations: Iterable[dict]):
+        """ Apply journal operations to DATA and the indexes
+        """
+        objs = DATA[cls.__name__]
+        indexes = self._all_indexes(cls)
+        for op in operations:
+            if op.get('op') == 'save':
+                obj = cls(**op['obj'])
+                objs[obj.id] = obj
+                for index in indexes:
+                    index.add(obj)
+            elif op.get('op') == 'remove':
+                if objs.pop(op['id'], None) is not None:
+                    for index in indexes:
+                        index.discard(op['id'])
+
+    def _reload_shards(self, cls: type, seen: dict, files: dict) -> bool:
+        """ Reload the shards that changed since seen
+
+        Return False, having changed nothing, unless only shards of the
+        current layout changed.
+        """
+        shards = {self._shard_path(cls, shard): shard
+                  for shard in range(cls.shards)}
+        changed = [file_path for file_path in files
+                   if files[file_path] != seen.get(file_path)]
+        if not changed or set(files) != set(seen) or \
+                not set(changed).issubset(shards):
+            return False
+        objs = DATA[cls.__name__]
+        shard_index = self._shard_index(cls)
+        indexes = self._all_indexes(cls)
+        reader = read_binary if cls.snapshot_format == "binary" \
+            else read_json
+        for file_path in changed:
+            fresh = {obj_id: cls(**obj_json)
+                     for obj_id, obj_json in reader(file_path).items()}
+            stale = [obj_id for obj_id in shard_index.lookup(shards[file_path])
+                     if obj_id not in fresh]
+            for obj_id in stale:
+                objs.pop(obj_id, None)
+            objs.update(fresh)
+            for index in indexes:
+                index.discard_many(stale)
+                index.add_many(fresh.values())
+        return True
+
+    def _extensions(self, cls: type) -> tuple:
+        """ Return the snapshot file extensions, the current format first
+        """
+        if cls.snapshot_format == "binary":
+            return ("bin", "json")
+        return ("json", "bin")
+
+    def _snapshot_path(self, cls: type) -> str:
+        """ Return the single-file snapshot path in the current format
+        """
+        return ".db_{}.{}".format(cls.__name__, self._extensions(cls)[0])
+
+    def _shard_path(self, cls: type, shard: int) -> str:
+        """ Return the file of one shard in the current format
+        """
+        return shard_path(cls.__name__, shard, cls.shards,
+                          self._extensions(cls)[0])
+
+    def _write_file(self, cls: type, file_path: str, objs: dict,
+                    commit: bool = True) -> str:
+        """ Write objects atomically in the current format
+
+        Objects that did not change since they were last written reuse
+        their cached serialized form. Without commit the file is left
+        at the returned temporary path.
+        """
+        if cls.snapshot_format == "binary":
+            return write_binary_atomic(file_path, {
+                obj_id: obj._json_view(True) for obj_id, obj in objs.items()},
+                commit=commit)
+        return write_json_atomic(file_path, {
+            obj_id: obj._json_text() for obj_id, obj in objs.items()},
+            encoded=True, commit=commit)
+
+    def _commit_path(self, cls: type) -> str:
+        """ Return the file listing the renames of a batch write
+        """
+        return ".db_{}.commit".format(cls.__name__)
+
+    def _write_files(self, cls: type, files: dict):
+        """ Write the objects of several files, all or none of them
+
+        Every file is written aside first. Once all were, the renames
+        are recorded in .db_<Class>.commit, which commits the batch, and
+        done; the record is then removed. A failure before the commit
+        leaves the previous files, and a crash after it is completed by
+        the next load or batch write, see _finish_commit.
+        """
+        self._finish_commit(cls)
+        written = []
+        try:
+            for file_path, objs in files.items():
+                written.append(
+                    (self._write_file(cls, file_path, objs, commit=False),
+                     file_path))
+        except Exception:
+            for tmp_path, _ in written:
+                os.remove(tmp_path)
+            raise
+        if not written:
+            return
+        commit_path = self._commit_path(cls)
+        if len(written) > 1:
+            write_json_atomic(commit_path, {
+                file_path: tmp_path for tmp_path, file_path in written})
+        for tmp_path, file_path in written:
+            os.replace(tmp_path, file_path)
+        fsync_directory(commit_path)
+        if len(written) > 1:
+            os.remove(commit_path)
+            fsync_directory(commit_path)
+
+    def _finish_commit(self, cls: type):
+        """ Complete the renames of a committed batch write, if any
+
+        Left by a crash between the commit of _write_files and its end:
+        the files not renamed yet still wait at their temporary path.
+        """
+        commit_path = self._commit_path(cls)
+        if not path.exists(commit_path):
+            return
+        for file_path, tmp_path in read_json(commit_path).items():
+            if path.exists(tmp_path):
+                os.replace(tmp_path, file_path)
+        fsync_directory(commit_path)
+        os.remove(commit_path)
+        fsync_directory(commit_path)
+
+    def _rebuild(self, cls: type, index, raw_value: Callable):
+        """ Fill an index with the objects of the class
+
+        Objects a lazy load has not built yet are indexed from their raw
+        dict with raw_value(obj_id, obj_json) instead, so that building
+        an index does not build them. A dict it raises KeyError for is
+        built after all.
+        """
+        objs = DATA.get(cls.__name__, {})
+        if not isinstance(objs, LazyObjects):
+            index.rebuild(objs.values())
+            return
+        items = []
+        for obj_id, value in objs.items_by_id.items():
+            if type(value) is dict:
+                try:
+                    items.append((obj_id, raw_value(obj_id, value)))
+                    continue
+                except KeyError:
+                    value = objs[obj_id]
+            items.append((obj_id, index.indexed_value(value)))
+        index.rebuild_values(items)
+
+    def _shard_index(self, cls: type) -> HashIndex:
+        """ Return the index of object IDs by shard, built on first use
+
+        Built as the other indexes are, see _indexes.
+        """
+        s_class = cls.__name__
+        index = SHARD_INDEXES.get(s_class)
+        if index is None:
+            with self._build_lock(cls):
+                index = SHARD_INDEXES.get(s_class)
+                if index is None:
+                    shards = cls.shards
+                    index = HashIndex(
+                        'id', key=lambda obj: shard_of(obj.id, shards))
+                    self._rebuild(cls, index, lambda obj_id, obj_json:
+                                  shard_of(obj_id, shards))
+                    SHARD_INDEXES[s_class] = index
+        return index
+
+    def _all_indexes(self, cls: type) -> list:
+        """ Return every index of the class kept in sync with DATA
+        """
+        indexes = list(self._indexes(cls).values()) + \
+            list(self._sorted_indexes(cls).values())
+        if cls.shards:
+            indexes.append(self._shard_index(cls))
+        return indexes
+
+    def _sorted_indexes(self, cls: type) -> dict:
+        """ Return the sorted indexes of the class, built on first use
+
+        Built as the hash indexes are, see _indexes.
+        """
+        s_class = cls.__name__
+        indexes = SORTED_INDEXES.get(s_class)
+        if indexes is None:
+            with self._build_lock(cls):
+                indexes = SORTED_INDEXES.get(s_class)
+                if indexes is None:
+                    indexes = {}
+                    for attribute in cls.sorted_attributes:
+                        raw_value = partial(_attribute_from_json, cls,
+                                            attribute)
+                        if cls.compact_objects and \
+                                attribute in TIMESTAMP_ATTRIBUTES:
+                            index = SortedIndex(attribute,
+                                                attrgetter("_" + attribute),
+                                                to_epoch)
+                            raw_value = partial(_epoch_seconds_from_json,
+                                                cls, attribute)
+                        else:
+                            index = SortedIndex(attribute)
+                        self._rebuild(cls, index, raw_value)
+                        indexes[attribute] = index
+                    SORTED_INDEXES[s_class] = indexes
+        return indexes
+
+    def _indexes(self, cls: type) -> dict:
+        """ Return the hash indexes of the class, built on first use
+
+        Readers may get here together under the read lock, so the first
+        one builds them under the build lock of the class, which the
+        others wait for, and publishes them only once complete.
+        """
+        s_class = cls.__name__
+        indexes = INDEXES.get(s_class)
+        if indexes is None:
+            with self._build_lock(cls):
+                indexes = INDEXES.get(s_class)
+                if indexes is None:
+                    indexes = {}
+                    for attribute in cls.indexed_attributes:
+                        index = HashIndex(attribute)
+                        self._rebuild(cls, index, partial(
+                            _attribute_from_json, cls, attribute))
+                        indexes[attribute] = index
+                    INDEXES[s_class] = indexes
+        return indexes
+
+    def _journal(self, cls: type) -> Journal:
+        """ Return the journal of the class
+        """
+        s_class = cls.__name__
+        if JOURNALS.get(s_class) is None:
+            JOURNALS[s_class] = Journal(".db_{}.journal".format(s_class))
+        return JOURNALS[s_class]
+
+    def _append_to_journal(self, cls: type, operations: List[dict]):
+        """ Append operations and start a compaction past the threshold
+        """
+        journal = self._journal(cls)
+        size = journal.append(operations)
+        if size > cls.journal_max_bytes and not journal.compacting:
+            journal.compacting = True
+            threading.Thread(target=self.compact, args=(cls,),
+                             daemon=True).start()
+
+    def compact(self, cls: type):
+        """ Fold the journal into a new snapshot file
+
+        Loading waits for a compaction in progress, which could
+        otherwise discard the journal it is replaying.
+        """
+        s_class = cls.__name__
+        journal = self._journal(cls)
+        try:
+            with journal.compaction, self._store_lock(cls):
+                self._sync(cls)
+                with journal.lock, self._lock(cls).read():
+                    journal.rotate()
+                    objs = list(DATA[s_class].values())
+                self._write_snapshot(cls, {obj.id: obj for obj in objs})
+                journal.discard_old()
+                self._publish(cls)
+        finally:
+            journal.compacting = False
+
+    def _save_all(self, cls: type):
+        """ Write every object of the class to the snapshot
+        """
+        s_class = cls.__name__
+        with self._lock(cls).read():
+            objs = dict(DATA[s_class].items())
+        self._write_snapshot(cls, objs)
+
+    def _write_snapshot(self, cls: type, objs: dict):
+        """ Write objects keyed by ID to the snapshot file or shards
+        """
+        if not cls.shards:
+            self._write_file(cls, self._snapshot_path(cls), objs)
+            other = ".db_{}.{}".format(cls.__name__,
+                                       self._extensions(cls)[1])
+            if path.exists(other):
+                os.replace(other, other + ".migrated")
+            return
+        shards = [{} for _ in range(cls.shards)]
+        for obj_id, obj in objs.items():
+            shards[shard_of(obj_id, cls.shards)][obj_id] = obj
+        self._write_files(cls, {self._shard_path(cls, shard): shard_objs
+                                for shard, shard_objs in enumerate(shards)})
+
+    def _shard_objects(self, cls: type, shard: int) -> dict:
+        """ Return the objects of one shard keyed by ID
+        """
+        s_class = cls.__name__
+        objs = DATA[s_class]
+        shard_objs = {}
+        with self._lock(cls).read():
+            for obj_id in self._shard_index(cls).lookup(shard):
+                obj = objs.get(obj_id)
+                if obj is not None:
+                    shard_objs[obj_id] = obj
+        return shard_objs
+
+    def _write(self, cls: type, operations: List[dict]):
+        """ Persist operations to the journal or the snapshot file
+
+        Sharded snapshots only rewrite the shards the operations touch.
+        Several operations go to the journal as one batch line.
+        """
+        if cls.journal:
+            if len(operations) > 1:
+                operations = [{'op': 'batch', 'ops': operations}]
+            self._append_to_journal(cls, operations)
+        elif cls.shards:
+            shards = {shard_of(op['id'], cls.shards) for op in operations}
+            self._write_files(cls, {self._shard_path(cls, shard):
+                                    self._shard_objects(cls, shard)
+                                    for shard in shards})
+        else:
+            self._save_all(cls)
+        self._publish(cls)
+
+    def _persist(self, cls: type, operations: List[dict]):
+        """ Write operations now or hand them to the write-behind buffer
+        """
+        if cls.durability == "immediate" or cls.multiprocess:
+            self._write(cls, operations)
+            return
+        s_class = cls.__name__
+        if WRITERS.get(s_class) is None:
+            periodic = cls.durability == "interval"
+            WRITERS[s_class] = WriteBehind(
+                partial(self._write, cls),
+                cls.flush_interval if periodic else None,
+                cls.flush_max_changes if periodic else None)
+        WRITERS[s_class].mark(operations)
+
+    def flush(self, cls: type):
+        """ Write the buffered changes of the class now
+        """
+        writer = WRITERS.get(cls.__name__)
+        if writer is not None:
+            writer.flush()
+
+    def load(self, cls: type):
+        """ Replace the objects of a class with the ones in its files
+
+        Changes still buffered by the write-behind are written first, as
+        the files would otherwise replace them. In journal mode the
+        journal is replayed over the snapshot. The time taken is recorded
+        in LOAD_STATS, served by GET /api/v1/stats/load, and logged.
+        """
+        lock = self._lock(cls)
+        with lock.update():
+            self.flush(cls)
+            with self._journal(cls).compaction, self._store_lock(cls):
+                generation = self._state(cls).generation() \
+                    if cls.multiprocess else None
+                with lock.write():
+                    self._load(cls)
+                self._remember(cls, generation)
+
+    def save_all(self, cls: type):
+        """ Write every object of a class to its files
+
+        In multi-process mode the changes of other processes are read
+        first, so they are not overwritten.
+        """
+        with self._store_lock(cls):
+            self._sync(cls)
+            self._save_all(cls)
+            self._publish(cls)
+
+    def save(self, obj: TypeVar('Base')):
+        """ Put an object in DATA and the indexes, then persist it
+        """
+        cls = obj.__class__
+        s_class = cls.__name__
+        lock = self._lock(cls)
+        with lock.update(), self._store_lock(cls):
+            self._sync(cls)
+            with lock.write():
+                obj.updated_at = datetime.utcnow()
+                DATA[s_class][obj.id] = obj
+                for index in self._all_indexes(cls):
+                    index.add(obj)
+            self._persist(cls, [
+                {'op': 'save', 'id': obj.id, 'obj': obj._json_view(True)}])
+
+    def remove(self, obj: TypeVar('Base')):
+        """ Take an object out of DATA and the indexes, then persist it
+        """
+        cls = obj.__class__
+        s_class = cls.__name__
+        lock = self._lock(cls)
+        with lock.update(), self._store_lock(cls):
+            self._sync(cls)
+            with lock.write():
+                if DATA[s_class].get(obj.id) is None:
+                    return
+                del DATA[s_class][obj.id]
+                for index in self._all_indexes(cls):
+                    index.discard(obj.id)
+            self._persist(cls, [{'op': 'remove', 'id': obj.id}])
+
+    def save_many(self, cls: type, batch: dict, touch: bool):
+        """ Save objects keyed by ID with a single write
+
+        When the write fails DATA and the indexes are restored before
+        raising.
+        """
+        s_class = cls.__name__
+        lock = self._lock(cls)
+        with lock.update(), self._store_lock(cls):
+            self._sync(cls)
+            with lock.write():
+                if touch:
+                    updated_at = datetime.utcnow()
+                    for obj in batch.values():
+                        obj.updated_at = updated_at
+                objs = DATA[s_class]
+                previous = {obj_id: objs[obj_id] for obj_id in batch
+                            if obj_id in objs}
+                objs.update(batch)
+                for index in self._all_indexes(cls):
+                    index.add_many(batch.values())
+            try:
+                self._persist(cls, [{'op': 'save', 'id': obj_id,
+                                     'obj': obj._json_view(True)}
+                                    for obj_id, obj in batch.items()])
+            except Exception:
+                with lock.write():
+                    for obj_id in batch:
+                        if obj_id in previous:
+                            objs[obj_id] = previous[obj_id]
+                        else:
+                            del objs[obj_id]
+                    for index in self._all_indexes(cls):
+                        index.discard_many(set(batch) - set(previous))
+                        index.add_many(previous.values())
+                raise
+
+    def remove_many(self, cls: type, ids: Iterable[str]):
+        """ Remove the objects of several IDs with a single write
+
+        When the write fails DATA and the indexes are restored before
+        raising.
+        """
+        s_class = cls.__name__
+        lock = self._lock(cls)
+        with lock.update(), self._store_lock(cls):
+            self._sync(cls)
+            with lock.write():
+                objs = DATA[s_class]
+                removed = {}
+                for obj_id in ids:
+                    if obj_id in objs and obj_id not in removed:
+                        removed[obj_id] = objs.pop(obj_id)
+                if not removed:
+                    return
+                for index in self._all_indexes(cls):
+                    index.discard_many(removed)
+            try:
+                self._persist(cls, [{'op': 'remove', 'id': obj_id}
+                                    for obj_id in removed])
+            except Exception:
+                with lock.write():
+                    objs.update(removed)
+                    for index in self._all_indexes(cls):
+                        index.add_many(removed.values())
+                raise
+
+    def count(self, cls: type) -> int:
+        """ Count the objects of a class in DATA
+        """
+        s_class = cls.__name__
+        self._refresh(cls)
+        with self._lock(cls).read():
+            return len(DATA[s_class].keys())
+
+    def get(self, cls: type, obj_id: str) -> TypeVar('Base'):
+        """ Return the object of an ID from DATA
+        """
+        s_class = cls.__name__
+        self._refresh(cls)
+        with self._lock(cls).read():
+            return DATA[s_class].get(obj_id)
+
+    def _candidates(self, cls: type,
+                    attributes: dict) -> List[TypeVar('Base')]:
+        """ Return the objects indexed with the value of an attribute
+
+        Returns None when no attribute is indexed. Must be called with
+        the read lock held.
+        """
+        objs = DATA[cls.__name__]
+        indexes = self._indexes(cls)
+        for k, v in attributes.items():
+            if k not in indexes:
+                continue
+            try:
+                ids = indexes[k].lookup(v)
+            except TypeError:
+                continue
+            return [objs[obj_id] for obj_id in ids if obj_id in objs]
+        return None
+
+    def search(self, cls: type, attributes: dict) -> List[TypeVar('Base')]:
+        """ Search the objects of a class in DATA
+
+        When an attribute is indexed, only the objects indexed with its
+        value are checked against the other attributes.
+        """
+        s_class = cls.__name__
+        self._refresh(cls)
+        with self._lock(cls).read():
+            candidates = self._candidates(cls, attributes)
+            if candidates is None:
+                candidates = DATA[s_class].values()
+            return [obj for obj in candidates if _matches(obj, attributes)]
+
+    def iterate(self, cls: type, attributes: dict, limit: int, offset: int,
+                position: tuple) -> Iterator[TypeVar('Base')]:
+        """ Yield the matching objects of a class in created_at order
+
+        When an attribute is indexed its matches are ordered at once.
+        Otherwise the created_at index is walked ITERATION_BATCH IDs at
+        a time, holding the read lock for each batch but not while the
+        objects are consumed, so objects saved or removed meanwhile are
+        seen or not but never twice.
+        """
+        end = None if limit is None else offset + limit
+
+        def _key(obj):
+            return (obj.created_at, obj.id)
+
+        self._refresh(cls)
+        with self._lock(cls).read():
+            candidates = self._candidates(cls, attributes)
+        if candidates is not None:
+            candidates = sorted((obj for obj in candidates
+                                 if _matches(obj, attributes)), key=_key)
+            if position is not None:
+                candidates = [obj for obj in candidates
+                              if _key(obj) > position]
+            yield from islice(candidates, offset, end)
+            return
+
+        value, obj_id = position or (None, None)
+        yield from islice((obj for obj in self._walk(cls, value, obj_id)
+                           if _matches(obj, attributes)), offset, end)
+
+    def _walk(self, cls: type, value: datetime,
+              obj_id: str) -> Iterator[TypeVar('Base')]:
+        """ Yield the objects after (value, obj_id) in created_at order
+        """
+        s_class = cls.__name__
+        lock = self._lock(cls)
+        while True:
+            with lock.read():
+                index = self._sorted_indexes(cls).get('created_at')
+                if index is None:
+                    raise ValueError("{} objects are not sorted by "
+                                     "created_at".format(s_class))
+                objs = DATA[s_class]
+                batch = [objs[obj_id] for obj_id in
+                         index.after(value, obj_id, ITERATION_BATCH)]
+            if not batch:
+                return
+            value, obj_id = batch[-1].created_at, batch[-1].id
+            yield from batch
+
+    def query(self, cls: type, conditions: List[tuple], order_by: str,
+              descending: bool, limit: int) -> List[TypeVar('Base')]:
+        """ Query the objects of a class in DATA through its indexes
+        """
+        s_class = cls.__name__
+        self._refresh(cls)
+        with self._lock(cls).read():
+            return run_query(DATA[s_class], conditions,
+                             self._indexes(cls), self._sorted_indexes(cls),
+                             order_by, descending, limit)
+
+
+@atexit.register
+def flush_all():
+    """ Write the buffered changes of every class
+    """
+    for writer in list(WRITERS.values()):
+        writer.flush()
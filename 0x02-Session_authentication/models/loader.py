@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+""" Loader module
+"""
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+from itertools import islice
+from typing import Callable, Iterator, List, Tuple
+
+
+def _chunk_bounds(f, start: int, end: int,
+                  chunk_size: int) -> Iterator[Tuple[int, int]]:
+    """ Yield (start, end) offsets of chunks ending on line boundaries
+    """
+    while start < end:
+        f.seek(min(start + chunk_size, end))
+        f.readline()
+        stop = min(f.tell(), end)
+        yield start, stop
+        start = stop
+
+
+def _parse_chunk(file_path: str, bounds: Tuple[int, int]) -> dict:
+    """ Parse the records of one chunk of a line-per-record snapshot
+    """
+    start, end = bounds
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        chunk = f.read(end - start).decode()
+    chunk = chunk.rstrip().rstrip(',')
+    return json.loads("{" + chunk + "}") if chunk else {}
+
+
+def read_snapshot(file_path: str, parallel_bytes: int) -> dict:
+    """ Return the objects of a JSON snapshot file
+
+    Snapshots written one record per line and larger than parallel_bytes
+    are split at line boundaries and parsed on worker processes. A file
+    that only looks like one, such as JSON dumped with an indent, fails
+    to parse in chunks and is then loaded at once.
+    """
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        head = f.read(2)
+        f.seek(max(0, size - 2))
+        tail = f.read(2)
+        if size < parallel_bytes or head != b"{\n" or tail != b"\n}":
+            f.seek(0)
+            return json.load(f)
+
+        workers = os.cpu_count() or 1
+        bounds = list(_chunk_bounds(f, 2, size - 2,
+                                    max(1, size // (workers * 4))))
+    objs_json = {}
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for chunk_json in executor.map(_parse_chunk,
+                                           [file_path] * len(bounds),
+                                           bounds):
+                objs_json.update(chunk_json)
+    except ValueError:
+        with open(file_path, 'rb') as f:
+            return json.load(f)
+    return objs_json
+
+
+def iter_snapshot(file_path: str) -> Iterator[Tuple[str, dict]]:
+    """ Yield the (ID, record) pairs of a JSON snapshot file
+
+    Snapshots written one record per line are read a line at a time, in
+    constant memory; others are loaded at once. So is the rest of a file
+    whose lines stop holding whole records, such as indented JSON, from
+    the first record not yielded yet.
+    """
+    yielded = 0
+    with open(file_path, 'r') as f:
+        if f.readline() == "{\n":
+            for line in f:
+                line = line.rstrip().rstrip(',')
+                if not line or line == "}":
+                    continue
+                try:
+                    record = json.loads("{" + line + "}")
+                except ValueError:
+                    break
+                yield next(iter(record.items()))
+                yielded += 1
+            else:
+                return
+        f.seek(0)
+        yield from islice(json.load(f).items(), yielded, None)
+
+
+class LazyObjects(MutableMapping):
+    """ Mapping of object IDs that builds each object on first access
+
+    Values start as the raw dicts read from the snapshot and are
+    replaced by objects built with factory the first time they are
+    read. Insertion order is kept.
+    """
+
+    def __init__(self, factory: Callable, raw: dict):
+        """ Initialize the mapping over raw dicts keyed by ID
+        """
+        self.factory = factory
+        self.items_by_id = raw
+
+    def __getitem__(self, obj_id: str):
+        """ Return the object of an ID, building it if needed
+        """
+        value = self.items_by_id[obj_id]
+        if type(value) is dict:
+            value = self.factory(**value)
+            self.items_by_id[obj_id] = value
+        return value
+
+    def __setitem__(self, obj_id: str, obj):
+        """ Store an object
+        """
+        self.items_by_id[obj_id] = obj
+
+    def __delitem__(self, obj_id: str):
+        """ Remove an object
+        """
+        del self.items_by_id[obj_id]
+
+    def __contains__(self, obj_id) -> bool:
+        """ Return whether an ID is stored, without building it
+        """
+        return obj_id in self.items_by_id
+
+    def __iter__(self) -> Iterator[str]:
+        """ Iterate over the IDs in insertion order
+        """
+        return iter(self.items_by_id)
+
+    def __len__(self) -> int:
+        """ Return the number of objects
+        """
+        return len(self.items_by_id)
+
+    def pending(self) -> List[str]:
+        """ Return the IDs whose object is not built yet
+        """
+        return [obj_id for obj_id, value in self.items_by_id.items()
+                if type(value) is dict]
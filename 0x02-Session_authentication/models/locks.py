@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+""" Locks module
+"""
+import threading
+
+
+class ReadWriteLock():
+    """ Lock shared by any number of readers or held by one writer
+
+    Waiting writers go before new readers so a steady flow of reads
+    cannot starve them. A thread holding the lock may take it again for
+    reading, and the writing thread for writing too; a reader may not
+    upgrade to writing. The separate update lock serializes writers
+    without blocking readers, so a writer can hold it while persisting
+    and only take the write lock for its in-memory changes.
+    """
+
+    def __init__(self):
+        """ Initialize an unlocked ReadWriteLock
+        """
+        self.mutex = threading.Lock()
+        self.condition = threading.Condition(self.mutex)
+        self.updates = threading.RLock()
+        self.reading = _Hold(self.acquire_read, self.release_read)
+        self.writing = _Hold(self.acquire_write, self.release_write)
+        self.local = threading.local()
+        self.readers = 0
+        self.writer = None
+        self.depth = 0
+        self.waiting_writers = 0
+
+    def acquire_read(self):
+        """ Wait until no writer holds or waits for the lock, then share it
+        """
+        held = getattr(self.local, 'reads', 0)
+        me = threading.get_ident()
+        with self.mutex:
+            if not held and self.writer != me:
+                while self.writer is not None or self.waiting_writers:
+                    self.condition.wait()
+                self.readers += 1
+        self.local.reads = held + 1
+
+    def release_read(self):
+        """ Release one read hold of the calling thread
+        """
+        self.local.reads -= 1
+        if self.local.reads or self.writer == threading.get_ident():
+            return
+        with self.mutex:
+            self.readers -= 1
+            if not self.readers:
+                self.condition.notify_all()
+
+    def acquire_write(self):
+        """ Wait until the lock is free, then hold it alone
+        """
+        me = threading.get_ident()
+        with self.mutex:
+            if self.writer == me:
+                self.depth += 1
+                return
+            if getattr(self.local, 'reads', 0):
+                raise RuntimeError("Cannot upgrade a read lock to write")
+            self.waiting_writers += 1
+            try:
+                while self.writer is not None or self.readers:
+                    self.condition.wait()
+            finally:
+                self.waiting_writers -= 1
+            self.writer = me
+            self.depth = 1
+
+    def release_write(self):
+        """ Release one write hold of the calling thread
+        """
+        with self.mutex:
+            self.depth -= 1
+            if not self.depth:
+                self.writer = None
+                self.condition.notify_all()
+
+    def read(self) -> '_Hold':
+        """ Return a context manager holding the lock for reading
+        """
+        return self.reading
+
+    def write(self) -> '_Hold':
+        """ Return a context manager holding the lock for writing
+        """
+        return self.writing
+
+    def update(self) -> threading.RLock:
+        """ Return a context manager serializing writers, not readers
+        """
+        return self.updates
+
+
+class _Hold():
+    """ Context manager calling an acquire and a release function
+    """
+
+    def __init__(self, acquire, release):
+        """ Initialize a _Hold from its two functions
+        """
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        """ Acquire the lock
+        """
+        self.acquire()
+
+    def __exit__(self, *exc_info):
+        """ Release the lock
+        """
+        self.release()
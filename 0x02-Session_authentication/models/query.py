@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+""" Query module
+"""
+from itertools import islice
+import operator
+from typing import Iterable, List, Optional, Tuple
+
+
+def _ordered(compare):
+    """ Wrap an ordering comparison so a None attribute never matches
+    """
+    return lambda a, b: a is not None and compare(a, b)
+
+
+OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': _ordered(operator.lt),
+    '<=': _ordered(operator.le),
+    '>': _ordered(operator.gt),
+    '>=': _ordered(operator.ge),
+    'in': lambda a, b: a in b,
+    'prefix': lambda a, b: isinstance(a, str) and a.startswith(b),
+}
+RANGE_OPERATORS = ('==', '<', '<=', '>', '>=')
+
+
+def validate(conditions: Iterable[tuple]):
+    """ Raise a ValueError for a condition with an unknown operator
+    """
+    for condition in conditions:
+        if len(condition) != 3 or condition[1] not in OPERATORS:
+            raise ValueError("Invalid condition: {}".format(condition))
+
+
+def matches(obj, conditions: Iterable[tuple]) -> bool:
+    """ Return whether obj satisfies every (attribute, op, value)
+    """
+    for attribute, op, value in conditions:
+        if not OPERATORS[op](getattr(obj, attribute, None), value):
+            return False
+    return True
+
+
+def _bounds(conditions: Iterable[tuple], attribute: str) -> Optional[dict]:
+    """ Merge the range conditions on attribute into one pair of bounds
+    """
+    bounds = None
+    for attr, op, value in conditions:
+        if attr != attribute or op not in RANGE_OPERATORS:
+            continue
+        bounds = bounds or {}
+        if op in ('==', '>', '>='):
+            bounds.update(low=value, include_low=(op != '>'))
+        if op in ('==', '<', '<='):
+            bounds.update(high=value, include_high=(op != '<'))
+    return bounds
+
+
+def plan(conditions: List[tuple], hash_indexes: dict, sorted_indexes: dict,
+         order_by: str = None,
+         descending: bool = False) -> Tuple[Optional[Iterable], bool]:
+    """ Pick the index that narrows the candidates of a query
+
+    Returns the candidate IDs, or None for a full scan, and whether they
+    already come in the requested order.
+    """
+    for attribute, op, value in conditions:
+        if op == '==' and attribute in hash_indexes:
+            return hash_indexes[attribute].lookup(value), False
+    for attribute, op, value in conditions:
+        if op == 'in' and attribute in hash_indexes:
+            ids = {}
+            for item in value:
+                ids.update(dict.fromkeys(hash_indexes[attribute].lookup(item)))
+            return ids, False
+    for attribute, op, value in conditions:
+        if attribute not in sorted_indexes:
+            continue
+        in_order = attribute == order_by
+        index = sorted_indexes[attribute]
+        if op == 'prefix':
+            return index.prefix(value, descending), in_order
+        bounds = _bounds(conditions, attribute)
+        if bounds is not None:
+            return index.range(descending=descending, **bounds), in_order
+    if order_by in sorted_indexes:
+        return sorted_indexes[order_by].ordered(descending), True
+    return None, False
+
+
+def run_query(objs: dict, conditions: List[tuple], hash_indexes: dict,
+              sorted_indexes: dict, order_by: str = None,
+              descending: bool = False, limit: int = None) -> list:
+    """ Return the objects of objs matching every condition
+    """
+    validate(conditions)
+    ids, in_order = plan(conditions, hash_indexes, sorted_indexes,
+                         order_by, descending)
+    if ids is None:
+        candidates = objs.values()
+    else:
+        candidates = (objs[obj_id] for obj_id in ids if obj_id in objs)
+    results = (obj for obj in candidates if matches(obj, conditions))
+
+    if order_by is not None and not in_order:
+        def _key(obj):
+            value = getattr(obj, order_by, None)
+            return (value is None, value) if not descending \
+                else (value is not None, value)
+        results = sorted(results, key=_key, reverse=descending)
+    return list(islice(results, limit))
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+""" Shards module
+"""
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import json
+import os
+import re
+import zlib
+from typing import Callable, Iterator, List
+
+
+def shard_of(obj_id: str, shards: int) -> int:
+    """ Return the shard of an object ID, stable across processes
+    """
+    return zlib.crc32(obj_id.encode()) % shards
+
+
+def shard_path(s_class: str, shard: int, shards: int,
+               ext: str = "json") -> str:
+    """ Return the file of one shard of a class
+    """
+    return ".db_{}.{}-of-{}.{}".format(s_class, shard, shards, ext)
+
+
+def shard_paths(s_class: str, ext: str = "json") -> List[str]:
+    """ Return every shard file of a class, whatever its shard count
+    """
+    pattern = re.compile(r"\.db_{}\.\d+-of-\d+\.{}$".format(
+        re.escape(s_class), re.escape(ext)))
+    return sorted(file_path
+                  for file_path in glob.glob(".db_{}.*.{}".format(
+                      glob.escape(s_class), ext))
+                  if pattern.search(file_path))
+
+
+def read_json(file_path: str) -> dict:
+    """ Return the content of a JSON file
+    """
+    with open(file_path, 'r') as f:
+        return json.load(f)
+
+
+def read_shards(file_paths: List[str],
+                reader: Callable[[str], dict] = read_json) -> Iterator[dict]:
+    """ Yield the content of every shard, parsed on worker processes
+    """
+    if len(file_paths) < 2:
+        yield from map(reader, file_paths)
+        return
+    workers = min(len(file_paths), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(reader, file_paths)
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+""" SQLite storage module
+"""
+from datetime import datetime
+import json
+import os
+import sqlite3
+import threading
+from typing import Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+from models.json_storage import JSONStorage
+from models.query import validate
+from models.storage import Storage
+
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+COMPARISONS = ('<', '<=', '>', '>=')
+BATCH_ROWS = 500
+
+
+def _quote(name: str) -> str:
+    """ Return a name quoted as an SQL identifier
+    """
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _column(attribute: str) -> str:
+    """ Return the SQL expression of an attribute of a stored object
+
+    Indexes are created on the same expression, so lookups using it
+    can use them.
+    """
+    if attribute == 'id':
+        return 'id'
+    if not attribute.isidentifier():
+        raise ValueError("Invalid attribute name: {}".format(attribute))
+    return "json_extract(data, '$.{}')".format(attribute)
+
+
+def _value(value):
+    """ Return a value as it compares with json_extract results
+    """
+    if isinstance(value, datetime):
+        return value.strftime(TIMESTAMP_FORMAT)
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, separators=(',', ':'))
+    return value
+
+
+def _successor(prefix: str) -> Optional[str]:
+    """ Return the least string above every string starting with prefix
+    """
+    code = ord(prefix[-1]) + 1
+    if code == 0xD800:
+        code = 0xE000
+    if code > 0x10FFFF:
+        return None
+    return prefix[:-1] + chr(code)
+
+
+def _condition(attribute: str, op: str, value) -> Tuple[str, list]:
+    """ Return the SQL clause of a query condition and its parameters
+
+    None never satisfies an ordering or prefix condition, as in memory.
+    """
+    column = _column(attribute)
+    if op == '==':
+        return "{} IS ?".format(column), [_value(value)]
+    if op == '!=':
+        return "{} IS NOT ?".format(column), [_value(value)]
+    if op in COMPARISONS:
+        return "{} {} ?".format(column, op), [_value(value)]
+    if op == 'in':
+        values = [_value(item) for item in value]
+        present = [item for item in values if item is not None]
+        clause = "{} IN ({})".format(column, ", ".join("?" * len(present))) \
+            if present else "0"
+        if len(present) < len(values):
+            clause = "({} OR {} IS NULL)".format(clause, column)
+        return clause, present
+    if not value:
+        return "typeof({}) = 'text'".format(column), []
+    upper = _successor(value)
+    if upper is None:
+        return "typeof({0}) = 'text' AND substr({0}, 1, ?) = ?".format(
+            column), [len(value), value]
+    return "{0} >= ? AND {0} < ?".format(column), [value, upper]
+
+
+class SQLiteStorage(Storage):
+    """ Storage keeping each class in a table of an SQLite database
+
+    Objects are only built when read, so a class need not fit in memory.
+    A row holds the ID and the JSON of an object, and the
+    indexed_attributes and sorted_attributes of the class get an index
+    on their JSON value, used by searches and queries on them. The
+    database runs in WAL mode, so readers in every thread and process go
+    on while one of them writes. Values are always bound, so each shape
+    of statement is prepared once per connection and then reused from
+    its statement cache.
+    """
+
+    def __init__(self, file_path: str):
+        """ Initialize an SQLiteStorage for a database file
+        """
+        self.path = file_path
+        self.local = threading.local()
+        self.tables = set()
+
+    def _connection(self) -> sqlite3.Connection:
+        """ Return the connection of the calling thread
+
+        A forked process opens its own rather than share its parent's.
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30.0,
+                                         cached_statements=256)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def _table(self, cls: type) -> str:
+        """ Return the quoted table of a class, created on first use
+        """
+        table = _quote(cls.__name__)
+        if cls.__name__ in self.tables:
+            return table
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS {} "
+                "(id TEXT PRIMARY KEY, data TEXT NOT NULL)".format(table))
+            for attribute in dict.fromkeys(cls.indexed_attributes +
+                                           cls.sorted_attributes):
+                connection.execute("CREATE INDEX IF NOT EXISTS {} ON {} ({})"
+                                   .format(_quote("{}_{}".format(
+                                       cls.__name__, attribute)),
+                                       table, _column(attribute)))
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS {} ON {} ({}, id)".format(
+                    _quote(cls.__name__ + "_order"), table,
+                    _column('created_at')))
+            connection.execute("CREATE TABLE IF NOT EXISTS imported "
+                               "(name TEXT PRIMARY KEY)")
+        self.tables.add(cls.__name__)
+        return table
+
+    def _objects(self, cls: type,
+                 rows: Iterable[tuple]) -> List[TypeVar('Base')]:
+        """ Return the objects of rows holding their JSON
+        """
+        return [cls(**json.loads(row[0])) for row in rows]
+
+    def _upsert(self, connection: sqlite3.Connection, table: str,
+                objs: Iterable[TypeVar('Base')]):
+        """ Insert or replace objects, in the caller's transaction
+        """
+        connection.executemany(
+            "INSERT INTO {} (id, data) VALUES (?, ?) ON CONFLICT (id) "
+            "DO UPDATE SET data = excluded.data".format(table),
+            ((obj.id, obj._json_text()) for obj in objs))
+
+    def load(self, cls: type):
+        """ Create the table of a class
+
+        The first time, the objects left in the files of the class by
+        the JSON storage are imported, so switching storage keeps them.
+        """
+        table = self._table(cls)
+        connection = self._connection()
+        imported = connection.execute(
+            "SELECT 1 FROM imported WHERE name = ?",
+            (cls.__name__,)).fetchone()
+        if imported is not None:
+            return
+        objs = JSONStorage().read_files(cls)
+        with connection:
+            self._upsert(connection, table, objs)
+            connection.execute("INSERT OR IGNORE INTO imported VALUES (?)",
+                               (cls.__name__,))
+
+    def save_all(self, cls: type):
+        """ Fold the write-ahead log into the database file
+
+        Every change is committed as it is made, so nothing else is
+        left to write.
+        """
+        self._table(cls)
+        self._connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def save(self, obj: TypeVar('Base')):
+        """ Insert or replace one object
+        """
+        obj.updated_at = datetime.utcnow()
+        table = self._table(obj.__class__)
+        connection = self._connection()
+        with connection:
+            self._upsert(connection, table, [obj])
+
+    def remove(self, obj: TypeVar('Base')):
+        """ Delete one object
+        """
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM {} WHERE id = ?".format(
+                self._table(obj.__class__)), (obj.id,))
+
+    def save_many(self, cls: type, batch: dict, touch: bool):
+        """ Insert or replace objects keyed by ID in one transaction
+        """
+        if touch:
+            updated_at = datetime.utcnow()
+            for obj in batch.values():
+                obj.updated_at = updated_at
+        table = self._table(cls)
+        connection = self._connection()
+        with connection:
+            self._upsert(connection, table, batch.values())
+
+    def remove_many(self, cls: type, ids: Iterable[str]):
+        """ Delete the objects of several IDs in one transaction
+        """
+        connection = self._connection()
+        with connection:
+            connection.executemany("DELETE FROM {} WHERE id = ?".format(
+                self._table(cls)), ((obj_id,) for obj_id in ids))
+
+    def count(self, cls: type) -> int:
+        """ Count the rows of a class
+        """
+        return self._connection().execute("SELECT COUNT(*) FROM {}".format(
+            self._table(cls))).fetchone()[0]
+
+    def get(self, cls: type, obj_id: str) -> TypeVar('Base'):
+        """ Return the object of an ID through the primary key
+        """
+        objs = self._objects(cls, self._connection().execute(
+            "SELECT data FROM {} WHERE id = ?".format(self._table(cls)),
+            (obj_id,)))
+        return objs[0] if objs else None
+
+    def search(self, cls: type, attributes: dict) -> List[TypeVar('Base')]:
+        """ Return the objects whose attributes equal the given values
+
+        Objects come in insertion order.
+        """
+        return self.query(cls, [(attribute, '==', value)
+                                for attribute, value in attributes.items()],
+                          None, False, None)
+
+    def iterate(self, cls: type, attributes: dict, limit: int, offset: int,
+                position: tuple) -> Iterator[TypeVar('Base')]:
+        """ Yield the matching objects in created_at order, by batches
+
+        Each batch is one statement seeking the (created_at, id) index
+        to the last row of the previous one, so deep pages cost no more
+        than the first, unlike paging by OFFSET.
+        """
+        clauses, parameters = [], []
+        for attribute, value in attributes.items():
+            clause, values = _condition(attribute, '==', value)
+            clauses.append(clause)
+            parameters.extend(values)
+        column = _column('created_at')
+        after = "{0} >= ? AND ({0} > ? OR id > ?)".format(column)
+        statement = "SELECT data FROM {} WHERE {} ORDER BY {}, id " \
+            "LIMIT ? OFFSET ?".format(self._table(cls),
+                                      " AND ".join(clauses + [after]), column)
+        value, obj_id = position or ("", "")
+        while limit is None or limit > 0:
+            count = BATCH_ROWS if limit is None else min(limit, BATCH_ROWS)
+            objs = self._objects(cls, self._connection().execute(
+                statement, parameters + [_value(value), _value(value),
+                                         obj_id, count, offset]))
+            yield from objs
+            if len(objs) < count:
+                return
+            if limit is not None:
+                limit -= len(objs)
+            offset = 0
+            value, obj_id = objs[-1].created_at, objs[-1].id
+
+    def query(self, cls: type, conditions: List[tuple], order_by: str,
+              descending: bool, limit: int) -> List[TypeVar('Base')]:
+        """ Return the objects matching every condition in one statement
+
+        Objects equal for order_by keep their insertion order, and None
+        sorts last either way, as in memory.
+        """
+        validate(conditions)
+        clauses, parameters = [], []
+        for attribute, op, value in conditions:
+            clause, values = _condition(attribute, op, value)
+            clauses.append(clause)
+            parameters.extend(values)
+        statement = "SELECT data FROM {}".format(self._table(cls))
+        if clauses:
+            statement += " WHERE " + " AND ".join(clauses)
+        statement += " ORDER BY "
+        if order_by is not None:
+            statement += "{} {} NULLS LAST, ".format(
+                _column(order_by), "DESC" if descending else "ASC")
+        statement += "rowid LIMIT ?"
+        parameters.append(-1 if limit is None else limit)
+        return self._objects(cls, self._connection().execute(
+            statement, parameters))
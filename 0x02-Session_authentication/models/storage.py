@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+""" Storage module
+"""
+from abc import ABC, abstractmethod
+from typing import Iterable, Iterator, List, TypeVar
+
+
+class Storage(ABC):
+    """ Where the objects of the model classes are kept
+
+    Base hands every load, save, removal and lookup to the storage named
+    by MODELS_STORAGE, passing the model class along, so one storage
+    serves every class. A storage implements every abstract method;
+    flush and compact only matter to one that defers or logs writes.
+    """
+
+    @abstractmethod
+    def load(self, cls: type):
+        """ Make the stored objects of a class available
+        """
+
+    @abstractmethod
+    def save_all(self, cls: type):
+        """ Make sure every object of a class is on disk
+        """
+
+    @abstractmethod
+    def save(self, obj: TypeVar('Base')):
+        """ Store one object, stamping its updated_at
+        """
+
+    @abstractmethod
+    def remove(self, obj: TypeVar('Base')):
+        """ Delete one object
+        """
+
+    @abstractmethod
+    def save_many(self, cls: type, objs: dict, touch: bool):
+        """ Store objects of a class keyed by ID, all or none of them
+
+        With touch their updated_at is stamped first.
+        """
+
+    @abstractmethod
+    def remove_many(self, cls: type, ids: Iterable[str]):
+        """ Delete the objects of several IDs, all or none of them
+        """
+
+    @abstractmethod
+    def count(self, cls: type) -> int:
+        """ Return the number of objects of a class
+        """
+
+    @abstractmethod
+    def get(self, cls: type, obj_id: str) -> TypeVar('Base'):
+        """ Return the object of an ID, or None
+        """
+
+    @abstractmethod
+    def search(self, cls: type, attributes: dict) -> List[TypeVar('Base')]:
+        """ Return the objects whose attributes equal the given values
+        """
+
+    @abstractmethod
+    def iterate(self, cls: type, attributes: dict, limit: int, offset: int,
+                position: tuple) -> Iterator[TypeVar('Base')]:
+        """ Yield the objects with matching attributes by created_at, ID
+
+        position is the (created_at, ID) pair to resume after, or None;
+        the other arguments are those of Base.iter_search.
+        """
+
+    @abstractmethod
+    def query(self, cls: type, conditions: List[tuple], order_by: str,
+              descending: bool, limit: int) -> List[TypeVar('Base')]:
+        """ Return the objects matching every condition
+
+        The conditions and the other arguments are those of Base.query.
+        """
+
+    def flush(self, cls: type):
+        """ Write the buffered changes of a class now
+
+        Nothing is buffered unless a storage says otherwise.
+        """
+
+    def compact(self, cls: type):
+        """ Fold the changes logged for a class into a new snapshot
+
+        Nothing is logged unless a storage says otherwise.
+        """
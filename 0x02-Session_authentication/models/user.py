@@ -9,6 +9,12 @@ class User(Base):
     """ User class
     """
 
+    indexed_attributes = ('email',)
+    sorted_attributes = ('created_at', 'updated_at', 'email')
+
+    if Base.compact_objects:
+        __slots__ = ('email', '_password', 'first_name', 'last_name')
+
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a User instance
         """
@@ -8,6 +8,11 @@ from models.base import Base
 class UserSession(Base):
     """Represents a user session"""
 
+    indexed_attributes = ('session_id', 'user_id')
+
+    if Base.compact_objects:
+        __slots__ = ('user_id', 'session_id')
+
     def __init__(self, *args: list, **kwargs: dict):
         """Initializes a class instance"""
 
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+""" Write-behind module
+"""
+import threading
+from typing import Callable, List
+
+
+class WriteBehind():
+    """ Coalesces the changes of one class into occasional writes
+
+    Changes are buffered and handed to a flush function at most once per
+    interval, or sooner after max_changes changes. Without an interval
+    nothing is written until flush is called, typically at exit. A
+    failed flush keeps its changes buffered for the next attempt.
+    """
+
+    def __init__(self, flush_function: Callable[[List[dict]], None],
+                 interval: float = None, max_changes: int = None):
+        """ Initialize a WriteBehind and start its flusher if periodic
+        """
+        self.flush_function = flush_function
+        self.interval = interval
+        self.max_changes = max_changes
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pending = []
+        self.changes = 0
+        if interval is not None:
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def mark(self, operations: List[dict]):
+        """ Record a change and wake the flusher once enough piled up
+        """
+        with self.lock:
+            self.pending.extend(operations)
+            self.changes += 1
+            full = self.max_changes is not None and \
+                self.changes >= self.max_changes
+        if full and self.interval is not None:
+            self.wakeup.set()
+
+    def flush(self):
+        """ Write the buffered changes, if any, right now
+        """
+        with self.flush_lock:
+            with self.lock:
+                operations, self.pending = self.pending, []
+                changes, self.changes = self.changes, 0
+            if not changes:
+                return
+            try:
+                self.flush_function(operations)
+            except Exception:
+                with self.lock:
+                    self.pending[:0] = operations
+                    self.changes += changes
+                raise
+
+    def _run(self):
+        """ Flush every interval, or when woken up by mark
+        """
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                continue
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+""" NDJSON export and import module
+
+Stream User and UserSession records as newline-delimited JSON, one
+record per line tagged with its "__class__", to move them between
+environments, snapshot formats or storages without loading a class and
+dumping it whole.
+
+Export reads the snapshot files record by record, or pages through the
+SQLite storage, so it runs in constant memory. Import saves the records
+by batches, written to a JSON snapshot every --flush-every batches; with
+--verify-passwords the password hashes of User records are checked by a
+pool of processes first. Progress and throughput are reported on stderr
+as the records go.
+"""
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+from typing import Iterable, Iterator, List, TextIO, Tuple
+
+
+CLASSES = ('User', 'UserSession')
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+PASSWORD_HASH = re.compile(r"[0-9a-f]{64}")
+
+
+class Progress():
+    """ Count records and report their rate on stderr
+
+    A line is written at most every interval seconds, then a last one
+    when done.
+    """
+
+    def __init__(self, action: str, interval: float):
+        """ Initialize a Progress starting now
+        """
+        self.action = action
+        self.interval = interval
+        self.started = time.perf_counter()
+        self.next_report = self.started + interval
+        self.records = 0
+        self.rejected = 0
+
+    def add(self, records: int, rejected: int = 0):
+        """ Count records done and rejected, reporting if it is time
+        """
+        self.records += records
+        self.rejected += rejected
+        now = time.perf_counter()
+        if now >= self.next_report:
+            self.report()
+            self.next_report = now + self.interval
+
+    def report(self, done: bool = False):
+        """ Write the counts and the rate so far
+        """
+        elapsed = time.perf_counter() - self.started
+        line = "{} {} {} records in {:.1f}s ({:.0f} records/s)".format(
+            self.action, "done:" if done else "...", self.records, elapsed,
+            self.records / elapsed if elapsed else 0)
+        if self.rejected:
+            line += ", {} rejected".format(self.rejected)
+        print(line, file=sys.stderr, flush=True)
+
+
+def _default(value):
+    """ Return the JSON form of values json does not handle
+    """
+    if isinstance(value, datetime):
+        return value.strftime(TIMESTAMP_FORMAT)
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
+
+def _file_records(file_path: str) -> Iterator[dict]:
+    """ Yield the records of a snapshot file in either format
+    """
+    from models.binary import iter_binary
+    from models.loader import iter_snapshot
+
+    if file_path.endswith(".bin"):
+        yield from iter_binary(file_path)
+    else:
+        for _, record in iter_snapshot(file_path):
+            yield record
+
+
+def records(cls: type) -> Iterator[dict]:
+    """ Yield the serialized objects of a class without loading it
+
+    With the JSON storage, the objects the journal touched are held
+    until the snapshot was read, then the ones it did not remove
+    follow, so memory is bounded by the journal and not the class.
+    """
+    if cls.storage != "json":
+        cls.load_from_file()
+        for obj in cls.iter_all():
+            yield obj._json_view(True)
+        return
+    from models.json_storage import batch_operations
+
+    storage = cls._storage()
+    with storage._store_lock(cls):
+        journaled = {}
+        if cls.journal:
+            for op in batch_operations(storage._journal(cls).replay()):
+                journaled[op.get('id')] = op
+        file_paths, file_path = storage._snapshot_files(cls)
+        if file_path is not None:
+            file_paths = [file_path]
+        for file_path in file_paths:
+            for record in _file_records(file_path):
+                if record['id'] not in journaled:
+                    yield record
+        for op in journaled.values():
+            if op.get('op') == 'save':
+                yield op['obj']
+
+
+def export(classes: List[type], output: TextIO, interval: float) -> Progress:
+    """ Write every record of the classes to output, one per line
+    """
+    progress = Progress("export", interval)
+    for cls in classes:
+        tag = {'__class__': cls.__name__}
+        for record in records(cls):
+            output.write(json.dumps(dict(tag, **record), default=_default))
+            output.write("\n")
+            progress.add(1)
+    output.flush()
+    progress.report(True)
+    return progress
+
+
+def batches(lines: Iterable[str],
+            batch_size: int) -> Iterator[Tuple[str, List[dict]]]:
+    """ Group the records of NDJSON lines into batches of one class
+
+    A batch holds consecutive records of the same class, at most
+    batch_size of them.
+    """
+    s_class, batch = None, []
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        name = record.pop('__class__', None)
+        if batch and (name != s_class or len(batch) >= batch_size):
+            yield s_class, batch
+            batch = []
+        s_class = name
+        batch.append(record)
+    if batch:
+        yield s_class, batch
+
+
+def verify_passwords(s_class: str,
+                     batch: List[dict]) -> Tuple[List[dict], List[str]]:
+    """ Check the password hashes of a batch of records
+
+    A plaintext "password" is hashed into "_password" as User.password
+    does; a "_password" that is not a SHA256 hex digest rejects the
+    record. Records of other classes pass through. Returns the valid
+    records and the reasons the others were rejected.
+    """
+    if s_class != 'User':
+        return batch, []
+    valid, rejected = [], []
+    for record in batch:
+        pwd = record.pop('password', None)
+        if type(pwd) is str:
+            record['_password'] = hashlib.sha256(
+                pwd.encode()).hexdigest().lower()
+        hashed = record.get('_password')
+        if hashed is None or (type(hashed) is str and
+                              PASSWORD_HASH.fullmatch(hashed)):
+            valid.append(record)
+        else:
+            rejected.append("User {}: invalid password hash".format(
+                record.get('id')))
+    return valid, rejected
+
+
+def verified(stream: Iterator[Tuple[str, List[dict]]],
+             workers: int) -> Iterator[Tuple[str, List[dict], List[str]]]:
+    """ Yield the batches of a stream checked by verify_passwords
+
+    The batches are checked by a pool of processes and come out in
+    order. At most two per worker are in flight, so memory stays
+    bounded however fast the input is read.
+    """
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque()
+        for s_class, batch in stream:
+            pending.append((s_class, executor.submit(verify_passwords,
+                                                     s_class, batch)))
+            if len(pending) >= 2 * workers:
+                s_class, future = pending.popleft()
+                yield (s_class,) + future.result()
+        while pending:
+            s_class, future = pending.popleft()
+            yield (s_class,) + future.result()
+
+
+def import_records(classes: List[type], lines: Iterable[str],
+                   batch_size: int, workers: int, interval: float,
+                   flush_every: int = 10) -> Progress:
+    """ Save the records of NDJSON lines by batches
+
+    Objects keep the ID and timestamps they were exported with. With
+    workers, password hashes are verified first. Records of a class not
+    in classes are rejected.
+
+    A JSON snapshot without a journal would be rewritten whole by every
+    batch, so its writes are held and flushed every flush_every batches
+    of the class instead: an interrupted import loses at most that many
+    batches, and fewer flushes mean fewer snapshot rewrites. With 0 they
+    are only flushed at the end.
+    """
+    by_name = {cls.__name__: cls for cls in classes}
+    for cls in classes:
+        cls.load_from_file()
+        if cls.storage == "json" and not cls.journal:
+            cls.durability = "shutdown"
+    unflushed = dict.fromkeys(by_name, 0)
+    stream = batches(lines, batch_size)
+    if workers:
+        stream = verified(stream, workers)
+    else:
+        stream = ((s_class, batch, []) for s_class, batch in stream)
+
+    progress = Progress("import", interval)
+    for s_class, batch, rejected in stream:
+        cls = by_name.get(s_class)
+        if cls is None:
+            rejected += ["{} {}: unknown class".format(s_class,
+                                                       record.get('id'))
+                         for record in batch]
+            batch = []
+        for reason in rejected:
+            print(reason, file=sys.stderr)
+        if batch:
+            cls.save_many((cls(**record) for record in batch), touch=False)
+            unflushed[s_class] += 1
+            if unflushed[s_class] == flush_every:
+                cls.flush()
+                unflushed[s_class] = 0
+        progress.add(len(batch), len(rejected))
+    for cls in classes:
+        cls.flush()
+    progress.report(True)
+    return progress
+
+
+def main() -> None:
+    """ Parse the command line and run the export or the import
+    """
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--classes', nargs='+', choices=CLASSES,
+                        default=list(CLASSES),
+                        help="classes to move (default: all)")
+    common.add_argument('--progress-interval', type=float, default=1.0,
+                        help="seconds between progress lines (default: 1)")
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    export_parser = commands.add_parser(
+        'export', parents=[common],
+        help="write the stored records as NDJSON")
+    export_parser.add_argument('--output', default='-',
+                               help="NDJSON file, '-' for stdout (default)")
+    import_parser = commands.add_parser(
+        'import', parents=[common],
+        help="save the records of an NDJSON file")
+    import_parser.add_argument('--input', default='-',
+                               help="NDJSON file, '-' for stdin (default)")
+    import_parser.add_argument('--batch-size', type=int, default=1000,
+                               help="records per write (default: 1000)")
+    import_parser.add_argument('--flush-every', type=int, default=10,
+                               help="batches of a class between writes of "
+                               "a JSON snapshot, 0 for only at the end "
+                               "(default: 10)")
+    import_parser.add_argument('--verify-passwords', action='store_true',
+                               help="check User password hashes first")
+    import_parser.add_argument('--workers', type=int,
+                               default=os.cpu_count() or 1,
+                               help="verification processes "
+                               "(default: one per CPU)")
+    args = parser.parse_args()
+
+    from models.user import User
+    from models.user_session import UserSession
+
+    classes = [cls for cls in (User, UserSession)
+               if cls.__name__ in args.classes]
+    if args.command == 'export':
+        if args.output == '-':
+            export(classes, sys.stdout, args.progress_interval)
+        else:
+            with open(args.output, 'w') as f:
+                export(classes, f, args.progress_interval)
+        return
+    if args.batch_size < 1 or args.workers < 1:
+        parser.error("--batch-size and --workers must be positive")
+    if args.flush_every < 0:
+        parser.error("--flush-every must not be negative")
+    workers = args.workers if args.verify_passwords else 0
+    if args.input == '-':
+        progress = import_records(classes, sys.stdin, args.batch_size,
+                                  workers, args.progress_interval,
+                                  args.flush_every)
+    else:
+        with open(args.input, 'r') as f:
+            progress = import_records(classes, f, args.batch_size,
+                                      workers, args.progress_interval,
+                                      args.flush_every)
+    if progress.rejected:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
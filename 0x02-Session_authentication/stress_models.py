@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+""" Stress module
+
+Run threads doing mixed searches, queries and saves on User against a
+scratch directory, then check that no thread failed, that the indexes
+agree with DATA and that the file on disk holds what is in memory.
+With --processes N the threads run in N processes sharing the directory
+in MODELS_MULTIPROCESS mode; each process also saves one marker user and
+must see the markers of all others within MODELS_SYNC_INTERVAL, and all
+of them must end up with what is on disk. Exits with status 1 on any
+failure.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+
+def reader(stop: threading.Event, stats: dict, errors: list, seed: int):
+    """ Search, query and list users until stopped
+    """
+    from models.user import User
+
+    rng = random.Random(seed)
+    operations = 0
+    while not stop.is_set():
+        try:
+            choice = rng.random()
+            if choice < 0.4:
+                email = "user{}@example.com".format(rng.randrange(1000))
+                for user in User.search({'email': email}):
+                    if user.email != email:
+                        raise AssertionError("search returned " + user.email)
+            elif choice < 0.7:
+                User.query(('email', 'prefix', "user{}".format(
+                    rng.randrange(10))), order_by='email', limit=20)
+            elif choice < 0.9:
+                [user.to_json() for user in User.all()]
+            else:
+                User.count()
+            operations += 1
+        except Exception:
+            errors.append(traceback.format_exc())
+            return
+    stats['reads'] += operations
+
+
+def writer(stop: threading.Event, stats: dict, errors: list, seed: int):
+    """ Create, update and remove users until stopped
+    """
+    from models.user import User
+
+    rng = random.Random(seed)
+    operations = 0
+    while not stop.is_set():
+        try:
+            choice = rng.random()
+            email = "user{}@example.com".format(rng.randrange(1000))
+            if choice < 0.4:
+                User(email=email).save()
+            elif choice < 0.6:
+                users = User.search({'email': email})
+                if users:
+                    users[0].first_name = "Name{}".format(operations)
+                    users[0].save()
+            elif choice < 0.8:
+                User.save_many(User(email="user{}@example.com".format(
+                    rng.randrange(1000))) for _ in range(5))
+            else:
+                User.remove_many(user.id for user in
+                                 User.search({'email': email}))
+            operations += 1
+        except Exception:
+            errors.append(traceback.format_exc())
+            return
+    stats['writes'] += operations
+
+
+def check_indexes() -> list:
+    """ Return the inconsistencies between DATA and the indexes
+    """
+    from models.json_storage import DATA
+    from models.user import User
+
+    problems = []
+    if User.storage != "json":
+        return problems
+    objs = dict(DATA['User'])
+    indexes = User._storage()._indexes(User)
+    for email, ids in indexes['email'].entries.items():
+        ids = [ids] if isinstance(ids, str) else list(ids)
+        if any(obj_id not in objs or objs[obj_id].email != email
+               for obj_id in ids):
+            problems.append("email index out of sync for " + str(email))
+    if set(indexes['email'].values) != set(objs):
+        problems.append("email index misses objects")
+    ordered = [user.id for user in User.query(order_by='email')]
+    if sorted(ordered) != sorted(objs):
+        problems.append("sorted index misses objects")
+    return problems
+
+
+def digest() -> str:
+    """ Return a hash of every user in memory
+    """
+    from models.json_storage import DATA
+
+    objs = {obj_id: obj.to_json(True) for obj_id, obj in
+            dict(DATA['User']).items()}
+    return hashlib.sha256(
+        json.dumps(objs, sort_keys=True).encode()).hexdigest()
+
+
+def check() -> list:
+    """ Return the inconsistencies between DATA, indexes and the file
+    """
+    from models.json_storage import DATA
+    from models.user import User
+
+    problems = check_indexes()
+    objs = dict(DATA['User'])
+    expected = {obj_id: obj.to_json(True) for obj_id, obj in objs.items()}
+    User.flush()
+    User.load_from_file()
+    loaded = {obj_id: obj.to_json(True)
+              for obj_id, obj in DATA['User'].items()}
+    if loaded != expected:
+        problems.append("file differs from memory")
+    return problems
+
+
+def run_threads(args: argparse.Namespace) -> dict:
+    """ Run the reader and writer threads and return their statistics
+    """
+    stop = threading.Event()
+    stats = {'reads': 0, 'writes': 0}
+    errors = []
+    threads = [threading.Thread(target=reader,
+                                args=(stop, stats, errors, i))
+               for i in range(args.readers)]
+    threads += [threading.Thread(target=writer,
+                                 args=(stop, stats, errors, -i - 1))
+                for i in range(args.writers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {
+        'reads_per_sec': stats['reads'] / elapsed,
+        'writes_per_sec': stats['writes'] / elapsed,
+        'errors': errors,
+    }
+
+
+def child(args: argparse.Namespace, number: int) -> dict:
+    """ Run the threads in one of several processes and report its view
+    """
+    from models.user import User
+
+    User.load_from_file()
+    User(email="process{}@example.com".format(number)).save()
+    report = run_threads(args)
+    problems = report.pop('errors')
+
+    waited = time.perf_counter()
+    deadline = waited + User.sync_interval + 1.0
+    while len([number for number in range(args.processes)
+               if User.search({'email': "process{}@example.com".format(
+                   number)})]) < args.processes:
+        if time.perf_counter() > deadline:
+            problems.append("markers of other processes not visible")
+            break
+        time.sleep(0.01)
+    report['visible_after'] = time.perf_counter() - waited
+
+    report['problems'] = problems
+    return report
+
+
+def run_processes(args: argparse.Namespace) -> dict:
+    """ Run the threads in several processes and compare their views
+    """
+    children = [subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__),
+         '--readers', str(args.readers), '--writers', str(args.writers),
+         '--seconds', str(args.seconds),
+         '--processes', str(args.processes), '--child', str(number)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        for number in range(args.processes)]
+    reports = [json.loads(process.stdout.readline()) for process in children]
+    finals = [json.loads(process.communicate(b"\n")[0])
+              for process in children]
+    digests = {final['digest'] for final in finals}
+    from models.user import User
+
+    User.load_from_file()
+    problems = [problem for report in reports + finals
+                for problem in report['problems']]
+    if digests != {digest()}:
+        problems.append("processes differ from the file")
+    for number in range(args.processes):
+        if not User.search({'email': "process{}@example.com".format(
+                number)}):
+            problems.append("marker {} lost".format(number))
+    return {'processes': reports, 'problems': problems}
+
+
+def main() -> None:
+    """ Parse the command line, run the threads and report as JSON
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(child(args, args.child)), flush=True)
+        sys.stdin.readline()
+        from models.user import User
+
+        storage = User._storage()
+        with storage._store_lock(User):
+            storage._sync(User)
+            print(json.dumps({'digest': digest(),
+                              'problems': check_indexes()}))
+        return
+
+    os.chdir(tempfile.mkdtemp(prefix="stress_models_"))
+    if args.processes > 1:
+        os.environ['MODELS_MULTIPROCESS'] = "1"
+    from models.user import User
+    User.load_from_file()
+    User.save_many(User(email="user{}@example.com".format(i))
+                   for i in range(1000))
+
+    if args.processes > 1:
+        report = run_processes(args)
+    else:
+        report = run_threads(args)
+        report['problems'] = report.pop('errors') + check()
+    json.dump(dict({
+        'directory': os.getcwd(),
+        'readers': args.readers,
+        'writers': args.writers,
+    }, **report), sys.stdout, indent=2)
+    print()
+    sys.exit(1 if report['problems'] else 0)
+
+
+if __name__ == '__main__':
+    main()